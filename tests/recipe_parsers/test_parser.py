@@ -6,8 +6,8 @@ import re
 from os import path
 import unittest
 from tempfile import TemporaryDirectory
-from datetime import datetime, timezone
-from toltec import parse_recipe
+from datetime import datetime, timedelta, timezone
+from toltec import parse_recipe, parse_recipe_cached
 from toltec.bash import ScriptError
 from toltec.recipe import Package, Recipe, Source, RecipeError, RecipeWarning
 from toltec.version import (
@@ -1115,6 +1115,182 @@ _configure() {
         self.assertEqual(part2.preremove, "")
         self.assertEqual(part2.postremove, "")
 
+    def test_timestamps(self) -> None:
+        """Check the forms of dates accepted in the timestamp field."""
+        rec_path = path.join(self.dir, "timestamps")
+        os.makedirs(rec_path)
+
+        def parse_timestamp(timestamp: str) -> datetime:
+            with open(path.join(rec_path, "package"), "w") as rec_def_file:
+                rec_def_file.write(
+                    f"""
+pkgnames=(timestamps)
+pkgdesc="A simple test for timestamp parsing"
+url=https://example.org/toltec/timestamps
+pkgver=1.0-1
+timestamp="{timestamp}"
+section="test"
+maintainer="None <none@example.org>"
+license=MIT
+
+package() {{
+    echo "Package function"
+}}
+"""
+                )
+
+            return parse_recipe(rec_path)["rmall"].timestamp
+
+        utc = timezone.utc
+        pst = timezone(timedelta(hours=-8))
+
+        for timestamp, expected in (
+            ("2021-07-31T20:44Z", datetime(2021, 7, 31, 20, 44, tzinfo=utc)),
+            (
+                "2023-12-23T20:46:51Z",
+                datetime(2023, 12, 23, 20, 46, 51, tzinfo=utc),
+            ),
+            (
+                "2021-07-31T20:44:05.25Z",
+                datetime(2021, 7, 31, 20, 44, 5, 250000, tzinfo=utc),
+            ),
+            (
+                "2021-03-14T14:20-08:00",
+                datetime(2021, 3, 14, 14, 20, tzinfo=pst),
+            ),
+            (
+                "2021-03-14T14:20-0800",
+                datetime(2021, 3, 14, 14, 20, tzinfo=pst),
+            ),
+            ("2021-03-14T14:20-08", datetime(2021, 3, 14, 14, 20, tzinfo=pst)),
+            ("2021-07-31T20:44", datetime(2021, 7, 31, 20, 44)),
+            ("2021-07-31", datetime(2021, 7, 31)),
+        ):
+            with self.subTest(timestamp=timestamp):
+                self.assertEqual(parse_timestamp(timestamp), expected)
+
+        for timestamp in (
+            "2021/07/31T20:44Z",
+            "20210731T2044Z",
+            "2021-07-31 20:44Z",
+            "2021-W30-6",
+            "2021-212",
+            "2021-07-31T20Z",
+            "2021-07-31T25:00Z",
+            "2021-02-30T20:44Z",
+            "yesterday",
+        ):
+            with self.subTest(timestamp=timestamp):
+                with self.assertRaisesRegex(
+                    RecipeError,
+                    re.escape(
+                        f"{rec_path}: Field 'timestamp' does not contain a \
+valid ISO-8601 date"
+                    ),
+                ):
+                    parse_timestamp(timestamp)
+
+    def test_no_recipe(self) -> None:
+        """Check that directories without a recipe are rejected."""
+        with self.assertRaisesRegex(
+            FileNotFoundError,
+            re.escape(
+                f"No recipe in a compatible format found in '{self.dir}'"
+            ),
+        ):
+            parse_recipe(self.dir)
+
+    def test_cached(self) -> None:
+        """Check that parsed recipes are reused until they change."""
+        rec_path = path.join(self.dir, "cached")
+        cache_dir = path.join(self.dir, "cache")
+        os.makedirs(rec_path)
+        rec_def_path = path.join(rec_path, "package")
+
+        def write_recipe(pkgver: str, mtime: int) -> None:
+            with open(rec_def_path, "w") as rec_def_file:
+                rec_def_file.write(
+                    f"""
+pkgnames=(cached)
+pkgdesc="Recipe parsed from the cache"
+url=https://example.org/toltec/cached
+pkgver={pkgver}
+timestamp=2021-07-31T20:44Z
+section="test"
+maintainer="None <none@example.org>"
+license=MIT
+
+package() {{
+    echo "Package function"
+}}
+"""
+                )
+
+            os.utime(rec_def_path, ns=(mtime, mtime))
+
+        write_recipe("1.0-1", 1_000_000_000)
+        first = parse_recipe_cached(rec_path, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        second = parse_recipe_cached(rec_path, cache_dir)
+        self.assertIsNot(first, second)
+        self.assertEqual(
+            second["rmall"].packages["cached"].control_fields(),
+            first["rmall"].packages["cached"].control_fields(),
+        )
+        self.assertEqual(
+            second["rmall"].packages["cached"].package,
+            parse_recipe(rec_path)["rmall"].packages["cached"].package,
+        )
+
+        write_recipe("2.0-1", 2_000_000_000)
+        third = parse_recipe_cached(rec_path, cache_dir)
+        self.assertEqual(
+            third["rmall"].packages["cached"].version,
+            Version(0, "2.0", "1"),
+        )
+
+        # The outdated entry is replaced instead of being kept around
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        (entry_name,) = os.listdir(cache_dir)
+        entry_path = path.join(cache_dir, entry_name)
+
+        def entry_key() -> bytes:
+            with open(entry_path, "rb") as entry:
+                return entry.read(40)
+
+        # Files in subdirectories are part of the recipe state, except for
+        # those in excluded directories
+        third_key = entry_key()
+        work_dir = path.join(rec_path, "build")
+        os.makedirs(work_dir)
+
+        with open(path.join(work_dir, "artifact"), "w") as artifact:
+            artifact.write("built")
+
+        parse_recipe_cached(rec_path, cache_dir, exclude=(work_dir,))
+        self.assertEqual(entry_key(), third_key)
+
+        os.makedirs(path.join(rec_path, "patches"))
+
+        with open(path.join(rec_path, "patches", "fix.patch"), "w") as patch:
+            patch.write("patch")
+
+        parse_recipe_cached(rec_path, cache_dir, exclude=(work_dir,))
+        fourth_key = entry_key()
+        self.assertNotEqual(fourth_key, third_key)
+
+        # Corrupted entries are parsed again and replaced
+        with open(entry_path, "wb") as entry:
+            entry.write(fourth_key + b"\x80\x05corrupted")
+
+        fifth = parse_recipe_cached(rec_path, cache_dir, exclude=(work_dir,))
+        self.assertEqual(
+            fifth["rmall"].packages["cached"].version,
+            Version(0, "2.0", "1"),
+        )
+        self.assertGreater(os.path.getsize(entry_path), 60)
+
     def test_errors(self) -> None:
         """Check error messages raised when invalid recipes are parsed."""
         rec_path = path.join(self.dir, "errors")
@@ -0,0 +1,128 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+
+import os
+from os import path
+import shutil
+import sys
+import unittest
+from tempfile import TemporaryDirectory
+from toltec import buildcache, parse_recipe
+from toltec.recipe import Source
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir_handle = TemporaryDirectory()
+        self.dir = self.dir_handle.name
+        self.rec_dir = path.join(self.dir, "hello")
+        shutil.copytree(
+            path.join(path.dirname(__file__), "fixtures", "hello"),
+            self.rec_dir,
+        )
+
+    def tearDown(self) -> None:
+        self.dir_handle.cleanup()
+
+    def test_inputs_digest(self) -> None:
+        work_dir = path.join(self.rec_dir, "build")
+        os.makedirs(work_dir)
+        digest = buildcache.inputs_digest(self.rec_dir, exclude=(work_dir,))
+
+        with open(path.join(work_dir, "output"), "w") as output:
+            output.write("excluded")
+
+        self.assertEqual(
+            buildcache.inputs_digest(self.rec_dir, exclude=(work_dir,)),
+            digest,
+        )
+
+        with open(path.join(self.rec_dir, "hello.c"), "a") as source:
+            source.write("\n")
+
+        self.assertNotEqual(
+            buildcache.inputs_digest(self.rec_dir, exclude=(work_dir,)),
+            digest,
+        )
+
+    def test_store_restore(self) -> None:
+        cache_dir = path.join(self.dir, "cache")
+        dist_dir = path.join(self.dir, "dist")
+        package = parse_recipe(self.rec_dir)["rmall"].packages["hello"]
+        key = buildcache.package_key(
+            buildcache.inputs_digest(self.rec_dir), package
+        )
+        assert key is not None
+        self.assertIsNone(buildcache.lookup(cache_dir, key))
+
+        built_path = path.join(dist_dir, package.filename())
+        os.makedirs(path.dirname(built_path))
+
+        with open(built_path, "w") as built:
+            built.write("package")
+
+        buildcache.store(cache_dir, key, built_path)
+        os.unlink(built_path)
+
+        cache_path = buildcache.lookup(cache_dir, key)
+        assert cache_path is not None
+        buildcache.restore(cache_path, built_path)
+
+        with open(built_path, "r") as restored:
+            self.assertEqual(restored.read(), "package")
+
+    def test_unpinned_sources(self) -> None:
+        recipe = parse_recipe(self.rec_dir)["rmall"]
+        recipe.sources = {
+            Source(
+                url="https://example.org/a.zip",
+                checksum="SKIP",
+                noextract=False,
+            )
+        }
+        self.assertIsNone(
+            buildcache.package_key(
+                buildcache.inputs_digest(self.rec_dir),
+                recipe.packages["hello"],
+            )
+        )
+
+    def test_hook_module(self) -> None:
+        hooks_dir = path.join(self.dir, "hooks")
+        os.makedirs(hooks_dir)
+        hook_path = path.join(hooks_dir, "buildcache_test_hook.py")
+
+        with open(hook_path, "w") as hook:
+            hook.write("def register(builder):\n    pass\n")
+
+        sys.path.insert(0, hooks_dir)
+
+        try:
+            digest = buildcache.inputs_digest(
+                self.rec_dir, hooks=("buildcache_test_hook",)
+            )
+
+            with open(hook_path, "a") as hook:
+                hook.write("\n")
+
+            self.assertNotEqual(
+                buildcache.inputs_digest(
+                    self.rec_dir, hooks=("buildcache_test_hook",)
+                ),
+                digest,
+            )
+        finally:
+            sys.path.remove(hooks_dir)
+
+    def test_image_ids(self) -> None:
+        package = parse_recipe(self.rec_dir)["rmall"].packages["hello"]
+        digest = buildcache.inputs_digest(self.rec_dir)
+        key = buildcache.package_key(digest, package, ("sha256:1",))
+        assert key is not None
+
+        self.assertNotEqual(
+            buildcache.package_key(digest, package, ("sha256:2",)), key
+        )
+        self.assertIsNone(
+            buildcache.package_key(digest, package, ("sha256:1", None))
+        )
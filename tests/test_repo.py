@@ -0,0 +1,83 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+
+import os
+from os import path
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from toltec import ipk
+from toltec.repo import make_index
+
+
+class TestRepo(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir_handle = TemporaryDirectory()
+        self.dir = self.dir_handle.name
+        self.dist_dir = path.join(self.dir, "dist")
+        self.cache_dir = path.join(self.dir, "cache")
+        self.pkg_path = path.join(self.dist_dir, "rmall", "foo.ipk")
+        os.makedirs(path.dirname(self.pkg_path))
+
+    def tearDown(self) -> None:
+        self.dir_handle.cleanup()
+
+    def write_package(self, description: str) -> None:
+        # Rewrite in place with a fixed modification time, like a rebuilt
+        # package that reuses the inode of its previous version
+        with open(self.pkg_path, "wb") as file:
+            ipk.write(
+                file,
+                epoch=1337,
+                metadata=f"Package: foo\nDescription: {description}\n",
+                scripts={},
+            )
+
+        os.utime(self.pkg_path, (1337, 1337))
+
+    def read_index(self) -> str:
+        with open(path.join(self.dist_dir, "rmall", "Packages")) as index:
+            return index.read()
+
+    def test_rebuilt_package(self) -> None:
+        self.write_package("first")
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+        first = self.read_index()
+        self.assertIn("Description: first", first)
+        size = os.stat(self.pkg_path).st_size
+
+        # Make sure the change time of the rewritten file differs
+        time.sleep(0.05)
+        self.write_package("First")
+        self.assertEqual(os.stat(self.pkg_path).st_size, size)
+
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+        second = self.read_index()
+        self.assertIn("Description: First", second)
+        self.assertNotEqual(first, second)
+
+    def test_cache_location(self) -> None:
+        self.write_package("first")
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+
+        self.assertEqual(
+            sorted(os.listdir(path.join(self.dist_dir, "rmall"))),
+            ["Packages", "Packages.gz", "foo.ipk"],
+        )
+
+        # One cache for each indexed directory, dist and dist/rmall
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        # Cached entries give the same index
+        first = self.read_index()
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+        self.assertEqual(self.read_index(), first)
+
+    def test_removed_package(self) -> None:
+        self.write_package("first")
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+        self.assertIn("Package: foo", self.read_index())
+
+        os.remove(self.pkg_path)
+        make_index(self.dist_dir, cache_dir=self.cache_dir)
+        self.assertEqual(self.read_index(), "")
@@ -1,13 +1,17 @@
 # Copyright (c) 2023 The Toltec Contributors
 # SPDX-License-Identifier: MIT
 
+import os
 import unittest
-import subprocess
+from unittest import mock
 import shutil
 
+from contextlib import redirect_stdout
+from io import StringIO
 from os import path
 from tempfile import TemporaryDirectory
-from toltec.hooks.strip import walk_elfs
+from toltec.__main__ import main
+from toltec.hooks.strip import walk_elfs, write_file_list
 from elftools.elf.elffile import ELFFile
 
 
@@ -16,31 +20,37 @@ class TestBuild(unittest.TestCase):
         self.dir = path.dirname(path.realpath(__file__))
         self.fixtures_dir = path.join(self.dir, "fixtures")
 
-    def test_strip(self) -> None:
-        with TemporaryDirectory() as tmp_dir:
-            rec_dir = path.join(self.fixtures_dir, "hello")
-            work_dir = path.join(tmp_dir, "build")
-            dist_dir = path.join(tmp_dir, "dist")
+        # Keep the caches written by builds away from those of the user
+        cache_home = self.enterContext(TemporaryDirectory())
+        self.enterContext(
+            mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home})
+        )
+
+    def make(self, rec_dir: str, work_dir: str, dist_dir: str) -> str:
+        stdout = StringIO()
 
-            result = subprocess.run(
+        with redirect_stdout(stdout), self.assertLogs() as logs:
+            returncode = main(
                 [
-                    "python3",
-                    "-m",
-                    "toltec",
                     "--work-dir",
                     work_dir,
                     "--dist-dir",
                     dist_dir,
                     "--",
                     rec_dir,
-                ],
-                capture_output=True,
-                check=False,
-            )
-            self.assertEqual(
-                result.returncode, 0, result.stderr.decode("utf-8")
+                ]
             )
-            self.assertEqual(result.stdout.decode("utf-8"), "")
+
+        self.assertEqual(returncode, 0, "\n".join(logs.output))
+        return stdout.getvalue()
+
+    def test_strip(self) -> None:
+        with TemporaryDirectory() as tmp_dir:
+            rec_dir = path.join(self.fixtures_dir, "hello")
+            work_dir = path.join(tmp_dir, "build")
+            dist_dir = path.join(tmp_dir, "dist")
+
+            self.assertEqual(self.make(rec_dir, work_dir, dist_dir), "")
             walk_elfs(
                 work_dir,
                 lambda i, p: self.assertIsNone(
@@ -68,28 +78,23 @@ class TestBuild(unittest.TestCase):
                         line = line.replace(src, target)
                     outfile.write(line)
 
-            result = subprocess.run(
-                [
-                    "python3",
-                    "-m",
-                    "toltec",
-                    "--work-dir",
-                    work_dir,
-                    "--dist-dir",
-                    dist_dir,
-                    "--",
-                    rec_dir,
-                ],
-                capture_output=True,
-                check=False,
-            )
-            self.assertEqual(
-                result.returncode, 0, result.stderr.decode("utf-8")
-            )
-            self.assertEqual(result.stdout.decode("utf-8"), "")
+            self.assertEqual(self.make(rec_dir, work_dir, dist_dir), "")
             walk_elfs(
                 work_dir,
                 lambda i, p: self.assertIsNotNone(
                     i.get_section_by_name(".symtab"), f"{p} is stripped"
                 ),
             )
+
+    def test_write_file_list(self) -> None:
+        with TemporaryDirectory() as src_dir, TemporaryDirectory() as lists_dir:
+            file_paths = [path.join(src_dir, name) for name in ("a b", "c")]
+            list_path = write_file_list(lists_dir, src_dir, file_paths)
+            (list_name,) = os.listdir(lists_dir)
+            self.assertEqual(list_path, f"/lists/{list_name}")
+
+            with open(path.join(lists_dir, list_name), "rb") as list_file:
+                self.assertEqual(list_file.read(), b"/src/a b\0/src/c\0")
+
+            # Nothing is written to the build directory
+            self.assertEqual(os.listdir(src_dir), [])
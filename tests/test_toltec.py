@@ -1,10 +1,15 @@
 # Copyright (c) 2021 The Toltec Contributors
 # SPDX-License-Identifier: MIT
 
+from contextlib import redirect_stdout
+from io import StringIO
+import os
 from os import path
 import unittest
+from unittest import mock
 from tempfile import TemporaryDirectory
-import subprocess
+from toltec.__main__ import main
+from toltec.util import LOGGING_FORMAT, LogFormatter
 
 
 def filter_index_entry(index_entry):
@@ -20,33 +25,40 @@ class TestBuild(unittest.TestCase):
         self.dir = path.dirname(path.realpath(__file__))
         self.fixtures_dir = path.join(self.dir, "fixtures")
 
+        # Keep the caches written by builds away from those of the user
+        cache_home = self.enterContext(TemporaryDirectory())
+        self.enterContext(
+            mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home})
+        )
+
     def test_build_rmkit(self) -> None:
         with TemporaryDirectory() as tmp_dir:
             rec_dir = path.join(self.fixtures_dir, "rmkit")
             work_dir = path.join(tmp_dir, "build")
             dist_dir = path.join(tmp_dir, "dist")
 
-            result = subprocess.run(
-                [
-                    "python3",
-                    "-m",
-                    "toltec",
-                    "--work-dir",
-                    work_dir,
-                    "--dist-dir",
-                    dist_dir,
-                    "--",
-                    rec_dir,
-                ],
-                capture_output=True,
-                check=False,
-            )
-            self.assertEqual(
-                result.returncode, 0, result.stderr.decode("utf-8")
+            stdout = StringIO()
+            formatter = LogFormatter(LOGGING_FORMAT)
+
+            with redirect_stdout(stdout), self.assertLogs() as logs:
+                returncode = main(
+                    [
+                        "--work-dir",
+                        work_dir,
+                        "--dist-dir",
+                        dist_dir,
+                        "--",
+                        rec_dir,
+                    ]
+                )
+
+            stderr = "".join(
+                formatter.format(record) + "\n" for record in logs.records
             )
-            self.assertEqual(result.stdout.decode("utf-8"), "")
+            self.assertEqual(returncode, 0, stderr)
+            self.assertEqual(stdout.getvalue(), "")
             self.assertEqual(
-                result.stderr.decode("utf-8"),
+                stderr,
                 """\
 [    INFO] toltec.builder: Fetching source files
 [    INFO] toltec.builder: Preparing source files
@@ -176,3 +188,7 @@ Depends: display
 Filename: bufshot_0.1.0-5_rmall.ipk""",
                     },
                 )
+
+            # The top-level folder, which contains no package, is indexed too
+            with open(path.join(dist_dir, "Packages"), "r") as index:
+                self.assertEqual(index.read(), "")
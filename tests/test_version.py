@@ -94,6 +94,8 @@ class TestVersion(unittest.TestCase):
             (Version(1, "1.0~~a", "7"), Version(1, "1.0~", "1")),
             (Version(1, "1.0~", "7"), Version(1, "1.0", "1")),
             (Version(1, "1.0", "7"), Version(1, "1.0a", "1")),
+            (Version(1, "1.0a", "7"), Version(1, "1.0a1", "1")),
+            (Version(1, "1.9", "7"), Version(1, "1.10", "1")),
         )
 
         for lower, greater in ordered_pairs:
@@ -3,3 +3,4 @@
 """Toltec build system"""
 
 from .recipe_parsers import parse as parse_recipe
+from .recipe_parsers import parse_cached as parse_recipe_cached
@@ -6,23 +6,244 @@ import argparse
 import os
 import sys
 from importlib.util import find_spec, spec_from_file_location, module_from_spec
-from typing import Dict, List, Optional
-from toltec import parse_recipe
-from toltec.builder import Builder
-from toltec.recipe import Package
-from toltec.repo import make_index
-from toltec import util
+from typing import Dict, Iterable, List, Optional, TYPE_CHECKING
+from toltec import parse_recipe, parse_recipe_cached
+from toltec.recipe import Package, RecipeBundle
+from toltec import buildcache, util
 
+if TYPE_CHECKING:
+    from toltec.builder import Builder
 
-def main() -> int:  # pylint:disable=too-many-branches
-    """Execute requested commands and return appropriate exit code."""
+
+def _positive_int(value: str) -> int:
+    """Parse a strictly positive integer CLI argument."""
+    try:
+        result = int(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            f"invalid int value: '{value}'"
+        ) from err
+
+    if result < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {result}")
+
+    return result
+
+
+def _register_hook(builder: "Builder", ident: str) -> None:
+    """
+    Load a user hook module and register its listeners.
+
+    :param builder: builder to register the listeners on
+    :param ident: name or path to the hook module
+    """
+    if ident and ident[0] in (".", "/"):
+        spec = spec_from_file_location("toltec.hooks.user", ident)
+    else:
+        spec = find_spec(ident)
+
+    if spec:
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)  # type: ignore
+        module.register(builder)  # type: ignore
+    else:
+        raise RuntimeError(f"Hook module '{ident}' couldn’t be loaded")
+
+
+def _select_packages(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    recipe_bundle: RecipeBundle,
+) -> Dict[str, List[Package]]:
+    """
+    Get the set of packages to build for each architecture, as requested
+    on the command line.
+
+    All unknown package names are reported at once, before any build is
+    started. Exits with status 2 if nothing is left to build.
+
+    :param parser: command line parser, used to report errors
+    :param args: parsed command line arguments
+    :param recipe_bundle: architecture versions of the recipe to make
+    :returns: set of packages to build for each architecture
+    """
+    build_matrix: Dict[str, List[Package]] = {}
+    wanted = dict.fromkeys(args.package_name or ())
+    missing: List[str] = []
+
+    for arch, recipes in recipe_bundle.items():
+        if args.arch_name and arch not in args.arch_name:
+            continue
+
+        if wanted:
+            # Each architecture has its own package objects, bound to its
+            # own recipe, so the selection cannot be shared between them,
+            # but each name is only looked up once
+            selected = build_matrix[arch] = []
+
+            for pkg_name in wanted:
+                package = recipes.packages.get(pkg_name)
+
+                if package is None:
+                    missing.append(f"{pkg_name} ({arch})")
+                else:
+                    selected.append(package)
+        else:
+            build_matrix[arch] = list(recipes.packages.values())
+
+    if missing:
+        parser.error(
+            "argument -p/--package-name: unknown packages: "
+            + ", ".join(sorted(missing))
+        )
+
+    # Exit early instead of starting the builder for nothing
+    if not any(build_matrix.values()):
+        parser.error(
+            "argument -a/--arch-name: no requested architecture is supported "
+            "by the recipe, available architectures are: "
+            + ", ".join(sorted(recipe_bundle))
+        )
+
+    return build_matrix
+
+
+def _package_images(package: Package, hooks: Iterable[str]) -> List[str]:
+    """
+    Get the names of the Docker images a package is built with.
+
+    :param package: package to get the images of
+    :param hooks: names or paths to the hook modules used for the build
+    """
+    # pylint: disable=import-outside-toplevel
+    from toltec.builder import Builder
+    from toltec.hooks.strip import TOOLCHAIN
+
+    images = [Builder.IMAGE_PREFIX + TOOLCHAIN]
+
+    if package.parent.image:
+        images.append(Builder.IMAGE_PREFIX + package.parent.image)
+
+    # Binaries of these recipes are patched with an image derived locally
+    # from the toolchain image
+    if (
+        "patch_rm2fb" in package.parent.flags
+        and "toltec.hooks.patch_rm2fb" in hooks
+    ):
+        from toltec.hooks.patch_rm2fb import PATCHELF_IMAGE
+
+        images.append(PATCHELF_IMAGE)
+
+    return images
+
+
+def _image_ids(
+    build_matrix: Dict[str, List[Package]], hooks: Iterable[str]
+) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Get the IDs of the Docker images that packages are built with.
+
+    :param build_matrix: set of packages to build for each architecture
+    :param hooks: names or paths to the hook modules used for the build
+    :returns: ID of each image, None for images that are not available
+        locally, or None if Docker cannot be reached
+    """
+    import docker  # pylint: disable=import-outside-toplevel
+
+    try:
+        client = docker.from_env()
+    except docker.errors.DockerException:
+        return None
+
+    try:
+        return {
+            image: buildcache.image_id(client, image)
+            for packages in build_matrix.values()
+            for package in packages
+            for image in _package_images(package, hooks)
+        }
+    finally:
+        client.close()
+
+
+def _restore_artifacts(
+    args: argparse.Namespace,
+    build_matrix: Dict[str, List[Package]],
+    cache_keys: Dict[str, str],
+) -> Dict[str, List[Package]]:
+    """
+    Restore the packages that were already built from identical inputs.
+
+    Packages of an architecture are only restored if all of them are
+    cached, since an architecture is otherwise built as a whole. Nothing is
+    restored if Docker cannot be reached, since the images that packages
+    are built with are then unknown.
+
+    :param args: parsed command line arguments
+    :param build_matrix: set of packages to build for each architecture
+    :param cache_keys: filled with the cache keys of packages that remain to
+        be built, indexed by package file name
+    :returns: set of packages that remain to be built for each architecture
+    """
+    hooks = args.hook or ()
+    image_ids = _image_ids(build_matrix, hooks)
+
+    if image_ids is None:
+        return build_matrix
+
+    cache_dir = buildcache.default_cache_dir()
+    digest = buildcache.inputs_digest(
+        args.recipe_dir,
+        exclude=(args.work_dir, args.dist_dir),
+        hooks=hooks,
+    )
+    remaining: Dict[str, List[Package]] = {}
+
+    for arch, packages in build_matrix.items():
+        keys = {
+            package.filename(): buildcache.package_key(
+                digest,
+                package,
+                (image_ids[image] for image in _package_images(package, hooks)),
+            )
+            for package in packages
+        }
+        cached = {
+            filename: buildcache.lookup(cache_dir, key) if key else None
+            for filename, key in keys.items()
+        }
+
+        if all(cached.values()):
+            for filename, cache_path in cached.items():
+                assert cache_path is not None
+                buildcache.restore(
+                    cache_path, os.path.join(args.dist_dir, filename)
+                )
+        else:
+            remaining[arch] = packages
+            cache_keys.update(
+                (filename, key) for filename, key in keys.items() if key
+            )
+
+    return remaining
+
+
+def main(
+    argv: Optional[List[str]] = None,
+) -> int:  # pylint:disable=too-many-branches
+    """
+    Execute requested commands and return appropriate exit code.
+
+    :param argv: command line arguments (default: sys.argv[1:])
+    """
+    cwd = os.getcwd()
     parser = argparse.ArgumentParser(description=__doc__)
 
     parser.add_argument(
         "recipe_dir",
         metavar="DIR",
         nargs="?",
-        default=os.getcwd(),
+        default=cwd,
         help="""path to a directory containing the recipe to build
         (default: current directory)""",
     )
@@ -31,7 +252,7 @@ def main() -> int:  # pylint:disable=too-many-branches
         "-w",
         "--work-dir",
         metavar="DIR",
-        default=os.path.join(os.getcwd(), "build"),
+        default=os.path.join(cwd, "build"),
         help="""path to a directory used for building the package
         (default: [current directory]/build)""",
     )
@@ -40,7 +261,7 @@ def main() -> int:  # pylint:disable=too-many-branches
         "-d",
         "--dist-dir",
         metavar="DIR",
-        default=os.path.join(os.getcwd(), "dist"),
+        default=os.path.join(cwd, "dist"),
         help="""path to a directory where built packages are stored
         (default: [current directory]/dist)""",
     )
@@ -73,51 +294,86 @@ def main() -> int:  # pylint:disable=too-many-branches
         either a dot or a slash""",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=_positive_int,
+        help="""maximum number of architectures to build at the same time
+        (default: number of CPUs available to the process)""",
+    )
+
+    parser.add_argument(
+        "--no-recipe-cache",
+        action="store_true",
+        help="""always parse the recipe, instead of reusing the result of a
+        previous run when the recipe has not changed""",
+    )
+
+    parser.add_argument(
+        "--artifact-cache",
+        action="store_true",
+        help="""reuse packages built by a previous run if the files of the
+        recipe directory, the build system, the user hooks and the Docker
+        images have not changed since, and save newly built packages for later
+        runs (packages using remote sources without a checksum are always
+        rebuilt)""",
+    )
+
     util.argparse_add_verbose(parser)
     util.argparse_add_warning(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    # Resolve paths once, so that the same directories are always designated
+    # by the same paths, whichever way they were passed
+    for name in ("recipe_dir", "work_dir", "dist_dir"):
+        setattr(args, name, os.path.realpath(getattr(args, name)))
+
     util.setup_logging(args)
 
-    recipe_bundle = parse_recipe(args.recipe_dir)
+    recipe_bundle = (
+        parse_recipe(args.recipe_dir)
+        if args.no_recipe_cache
+        else parse_recipe_cached(
+            args.recipe_dir, exclude=(args.work_dir, args.dist_dir)
+        )
+    )
 
-    with Builder(args.work_dir, args.dist_dir) as builder:
-        if args.hook:
-            for ident in args.hook:
-                if ident and ident[0] in (".", "/"):
-                    spec = spec_from_file_location("toltec.hooks.user", ident)
-                else:
-                    spec = find_spec(ident)
+    build_matrix = _select_packages(parser, args, recipe_bundle)
 
-                if spec:
-                    module = module_from_spec(spec)
-                    spec.loader.exec_module(module)  # type: ignore
-                    module.register(builder)  # type: ignore
-                else:
-                    raise RuntimeError(
-                        f"Hook module '{ident}' couldn’t be loaded"
-                    )
+    # Building pulls in Docker and HTTP clients, which are slow to import,
+    # so they are only loaded once the arguments are known to be valid
+    from toltec.builder import (  # pylint: disable=import-outside-toplevel
+        Builder,
+    )
+    from toltec.repo import (  # pylint: disable=import-outside-toplevel
+        make_index,
+    )
 
-        build_matrix: Optional[Dict[str, Optional[List[Package]]]] = None
+    cache_keys: Dict[str, str] = {}
 
-        if args.arch_name or args.package_name:
-            build_matrix = {}
+    if args.artifact_cache:
+        build_matrix = _restore_artifacts(args, build_matrix, cache_keys)
 
-            for arch, recipes in recipe_bundle.items():
-                if args.arch_name and arch not in args.arch_name:
-                    continue
+    if build_matrix:
+        with Builder(args.work_dir, args.dist_dir, args.jobs) as builder:
+            for ident in args.hook or ():
+                _register_hook(builder, ident)
 
-                if args.package_name:
-                    build_matrix[arch] = [
-                        recipes.packages[pkg_name]
-                        for pkg_name in args.package_name
-                    ]
-                else:
-                    build_matrix[arch] = None
+            if not builder.make(recipe_bundle, build_matrix):
+                return 1
 
-        if not builder.make(recipe_bundle, build_matrix):
-            return 1
+        for filename, key in cache_keys.items():
+            buildcache.store(
+                buildcache.default_cache_dir(),
+                key,
+                os.path.join(args.dist_dir, filename),
+            )
 
+    # Always index again, since packages may also have been removed from
+    # the dist directory since the last run
     make_index(args.dist_dir)
+
     return 0
 
 
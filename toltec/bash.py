@@ -7,8 +7,20 @@ import shlex
 import subprocess
 import logging
 from collections import deque
-from typing import Deque, Dict, Generator, List, Optional, Tuple, Union
-from docker.client import DockerClient
+from typing import (
+    Deque,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    TYPE_CHECKING,
+)
+
+if TYPE_CHECKING:
+    # Only needed for annotations, importing docker is slow
+    from docker.client import DockerClient
 
 AssociativeArray = Dict[str, str]
 IndexedArray = List[Optional[str]]
@@ -400,7 +412,7 @@ def run_script(variables: Variables, script: str) -> LogGenerator:
 
 
 def run_script_in_container(
-    docker: DockerClient,
+    docker: "DockerClient",
     image: str,
     mounts: List,
     variables: Variables,
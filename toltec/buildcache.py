@@ -0,0 +1,209 @@
+# Copyright (c) 2021 The Toltec Contributors
+# SPDX-License-Identifier: MIT
+"""
+Reuse packages built by previous runs from identical inputs.
+
+Packages are stored in a cache directory under a key derived from the
+files of their recipe, the code of the build system, the build hooks and
+the Docker images in use. Packages built from sources that are downloaded without checksum
+verification are never cached, since their inputs cannot be known.
+"""
+
+import hashlib
+from importlib.util import find_spec
+import os
+import shutil
+import sys
+from typing import Callable, Iterable, List, Optional, TYPE_CHECKING
+from . import util
+from .recipe import Package
+
+if TYPE_CHECKING:
+    # Only needed for annotations, importing docker is slow
+    from docker.client import DockerClient
+
+
+def default_cache_dir() -> str:
+    """Get the directory in which built packages are cached by default."""
+    return util.user_cache_dir("artifacts")
+
+
+def _update_file(update: Callable[[bytes], None], path: str) -> None:
+    """
+    Add the modification time and size of a file to a digest.
+
+    :param update: function updating the digest
+    :param path: path to the file
+    """
+    stat = os.stat(path)
+    update(f"\0{stat.st_mtime_ns}:{stat.st_size}".encode())
+
+
+def _hook_path(hook: str) -> Optional[str]:
+    """
+    Find the source of a user hook module.
+
+    :param hook: name or path of the hook module
+    :returns: path to the module file or package directory, or None if
+        the module has no source
+    """
+    if hook and hook[0] in (".", "/"):
+        return hook
+
+    spec = find_spec(hook)
+
+    if spec is None:
+        return None
+
+    if spec.submodule_search_locations:
+        return next(iter(spec.submodule_search_locations))
+
+    return spec.origin if spec.has_location else None
+
+
+def inputs_digest(
+    recipe_dir: str,
+    exclude: Iterable[str] = (),
+    hooks: Iterable[str] = (),
+) -> str:
+    """
+    Compute a digest of the inputs shared by all the packages of a recipe.
+
+    :param recipe_dir: path to the directory containing the recipe
+    :param exclude: directories inside the recipe directory that are not
+        inputs of the build, such as the work and dist directories
+    :param hooks: names or paths of the user hook modules in use
+    :returns: hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+
+    # Changes to the build system itself may change the built packages.
+    # Frozen applications bundle its modules inside the executable
+    if getattr(sys, "frozen", False):
+        _update_file(digest.update, sys.executable)
+    else:
+        util.update_tree_digest(
+            digest.update, os.path.dirname(__file__), suffix=".py"
+        )
+
+    digest.update(b"\0\0")
+    util.update_tree_digest(
+        digest.update,
+        recipe_dir,
+        exclude=(os.path.abspath(path) for path in exclude),
+    )
+
+    for hook in hooks:
+        digest.update(f"\0\0{hook}".encode())
+        hook_path = _hook_path(hook)
+
+        if hook_path is not None and os.path.isdir(hook_path):
+            util.update_tree_digest(digest.update, hook_path, suffix=".py")
+        elif hook_path is not None and os.path.isfile(hook_path):
+            _update_file(digest.update, hook_path)
+
+    return digest.hexdigest()
+
+
+def image_id(client: "DockerClient", name: str) -> Optional[str]:
+    """
+    Get the ID of a Docker image, which changes whenever the image is
+    updated even if its tag stays the same.
+
+    :param client: Docker client
+    :param name: name and tag of the image
+    :returns: ID of the image, or None if it is not available locally
+    """
+    images = client.images.list(name=name)
+    return images[0].id if images else None
+
+
+def package_key(
+    digest: str,
+    package: Package,
+    image_ids: Iterable[Optional[str]] = (),
+) -> Optional[str]:
+    """
+    Compute the key under which a package is cached.
+
+    :param digest: digest of the inputs of the recipe
+        (see :func:`inputs_digest`)
+    :param package: package to compute the key of
+    :param image_ids: IDs of the Docker images the package is built with
+        (see :func:`image_id`)
+    :returns: hexadecimal key, or None if the package cannot be cached
+        because some of its sources are downloaded without checksum or
+        some of its images are not available
+    """
+    for source in package.parent.sources:
+        if source.checksum == "SKIP" and "://" in source.url:
+            return None
+
+    images: List[str] = []
+
+    for image in image_ids:
+        if image is None:
+            return None
+
+        images.append(image)
+
+    return hashlib.blake2b(
+        "\0".join([digest, package.filename(), *sorted(images)]).encode(),
+        digest_size=20,
+    ).hexdigest()
+
+
+def _link(src_path: str, dest_path: str) -> None:
+    """
+    Atomically make a file available at another path, as a hard link if
+    possible or as a copy otherwise.
+
+    :param src_path: path to the existing file
+    :param dest_path: path at which the file is made available
+    """
+    if os.path.exists(dest_path) and os.path.samefile(src_path, dest_path):
+        return
+
+    temp_path = f"{dest_path}.{os.getpid()}.tmp"
+
+    try:
+        os.link(src_path, temp_path)
+    except OSError:
+        shutil.copy2(src_path, temp_path)
+
+    os.replace(temp_path, dest_path)
+
+
+def lookup(cache_dir: str, key: str) -> Optional[str]:
+    """
+    Find a cached package.
+
+    :param cache_dir: directory in which packages are cached
+    :param key: key of the package (see :func:`package_key`)
+    :returns: path to the cached package, or None if it is not cached
+    """
+    cache_path = os.path.join(cache_dir, key + ".ipk")
+    return cache_path if os.path.isfile(cache_path) else None
+
+
+def restore(cache_path: str, dest_path: str) -> None:
+    """
+    Restore a cached package.
+
+    :param cache_path: path to the cached package (see :func:`lookup`)
+    :param dest_path: path at which the package is restored
+    """
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    _link(cache_path, dest_path)
+
+
+def store(cache_dir: str, key: str, src_path: str) -> None:
+    """
+    Save a built package to the cache.
+
+    :param cache_dir: directory in which packages are cached
+    :param key: key of the package (see :func:`package_key`)
+    :param src_path: path to the built package
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    _link(src_path, os.path.join(cache_dir, key + ".ipk"))
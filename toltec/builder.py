@@ -2,46 +2,114 @@
 # SPDX-License-Identifier: MIT
 """Build recipes and create packages."""
 
+import hashlib
 import shutil
-from typing import List, Mapping, Optional, Type
-from types import TracebackType
-import re
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextvars import ContextVar
+from typing import Dict, List, Mapping, Optional, Type
+from types import ModuleType, TracebackType
 import os
 import logging
-import textwrap
-from importlib.util import find_spec, module_from_spec
+from importlib import import_module
 import docker
 import requests
-from . import hooks
-from . import bash, util, ipk
-from .recipe import RecipeBundle, Recipe, Package
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import bash, hooks, util, ipk
+from .recipe import RecipeBundle, Recipe, Package, Source
 from .version import DependencyKind
 
 logger = logging.getLogger(__name__)
 
+# Architecture built by the current thread, when several are built at once
+_current_arch: ContextVar[Optional[str]] = ContextVar(
+    "_current_arch", default=None
+)
+
+# Header of the generated package install scripts
+_SCRIPT_HEADER = """\
+#!/usr/bin/env bash
+set -euo pipefail
+"""
+
+# Wrapper running part of an install script only for a given action
+_SCRIPT_ACTION_OPEN = """\
+if [[ $1 = {action} ]]; then
+    script() {{
+"""
+_SCRIPT_ACTION_CLOSE = """\
+    }
+    script
+fi
+"""
+
 
 class BuildError(Exception):
     """Raised when a build step fails."""
 
 
+class _ArchFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Tag log records with the architecture whose build emitted them, so
+    that the interleaved logs of concurrent builds can be told apart (see
+    :class:`toltec.util.LogFormatter`).
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        arch = _current_arch.get()
+
+        if arch is not None:
+            record.arch = arch
+
+        return True
+
+
+def _load_hook_modules() -> List[ModuleType]:
+    """Get the built-in hook modules, in registration order."""
+    # Hook modules import this module, so they cannot be imported before
+    # it is fully initialized. The import system still only executes each
+    # of them once per process. The list and order of hooks is maintained
+    # in toltec.hooks.__all__ only
+    return [import_module(f"{hooks.__name__}.{name}") for name in hooks.__all__]
+
+
+def _is_url(path: str) -> bool:
+    """Detect non-local paths, i.e. paths starting with a 'scheme://'."""
+    scheme, separator, _ = path.partition("://")
+    return (
+        bool(separator)
+        and scheme.isascii()
+        and scheme.isalpha()
+        and scheme.islower()
+    )
+
+
 class Builder:  # pylint: disable=too-few-public-methods
     """Helper class for building recipes."""
 
-    # Detect non-local paths
-    URL_REGEX = re.compile(r"[a-z]+://")
-
     # Prefix for all Toltec Docker images
     IMAGE_PREFIX = "ghcr.io/toltec-dev/"
 
-    def __init__(self, work_dir: str, dist_dir: str) -> None:
+    # Maximum number of source files downloaded concurrently
+    FETCH_WORKERS = 8
+
+    # Size of the blocks in which source files are copied and downloaded
+    FETCH_CHUNK_SIZE = 1 << 20
+
+    def __init__(
+        self, work_dir: str, dist_dir: str, jobs: Optional[int] = None
+    ) -> None:
         """
         Create a builder helper.
 
         :param work_dir: directory where packages are built
         :param dist_dir: directory where built packages are stored
+        :param jobs: maximum number of architectures built at the same time
+            (default: number of CPUs available to the process)
         """
         self.work_dir = work_dir
         self.dist_dir = dist_dir
+        self.jobs = jobs if jobs is not None else util.available_cpus()
 
         try:
             self.docker = docker.from_env()
@@ -52,16 +120,24 @@ Please check that the service is running and that you have the necessary \
 permissions."
             ) from err
 
-        for hook in hooks.__all__:
-            spec = find_spec(f"toltec.hooks.{hook}")
-            if spec:
-                module = module_from_spec(spec)
-                spec.loader.exec_module(module)  # type: ignore
-                module.register(self)  # type: ignore
-            else:
-                raise RuntimeError(
-                    f"Hook module 'toltec.hooks.{hook}' couldn’t be loaded"
-                )
+        # Shared HTTP session, so that connections to the same host are
+        # reused between source files and recipes
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=self.FETCH_WORKERS,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+
+        for module in _load_hook_modules():
+            module.register(self)  # type: ignore
 
     def __enter__(self) -> "Builder":
         return self
@@ -72,6 +148,7 @@ permissions."
         exc_value: Optional[BaseException],
         traceback: Optional[TracebackType],
     ) -> None:
+        self._http.close()
         self.docker.close()
 
     @util.hook
@@ -157,20 +234,74 @@ or [k]eep it (not recommended)?",
         os.makedirs(self.work_dir, exist_ok=True)
         os.makedirs(self.dist_dir, exist_ok=True)
 
-        for name in (
+        names = (
             list(build_matrix.keys())
             if build_matrix is not None
             else list(recipe_bundle.keys())
-        ):
-            if not self._make_arch(
-                recipe_bundle[name],
-                os.path.join(self.work_dir, name),
-                build_matrix[name] if build_matrix is not None else None,
-            ):
-                return False
+        )
+
+        # Records of handlers added after this point, or of hooks logging
+        # from threads of their own, are not tagged
+        handlers = list(logging.getLogger().handlers) if len(names) > 1 else []
+        arch_filter = _ArchFilter()
+
+        for handler in handlers:
+            handler.addFilter(arch_filter)
+
+        # Each architecture is built in its own directory and container,
+        # so they can be built concurrently
+        try:
+            with ThreadPoolExecutor(
+                max_workers=max(1, min(len(names), self.jobs))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._make_arch_tagged,
+                        name if handlers else None,
+                        recipe_bundle[name],
+                        os.path.join(self.work_dir, name),
+                        (
+                            build_matrix[name]
+                            if build_matrix is not None
+                            else None
+                        ),
+                    )
+                    for name in names
+                ]
+
+                try:
+                    for future in as_completed(futures):
+                        if not future.result():
+                            return False
+                finally:
+                    # Do not start pending builds after a failure
+                    for future in futures:
+                        future.cancel()
+        finally:
+            for handler in handlers:
+                handler.removeFilter(arch_filter)
 
         return True
 
+    def _make_arch_tagged(
+        self,
+        arch: Optional[str],
+        recipe: Recipe,
+        build_dir: str,
+        packages: Optional[List[Package]] = None,
+    ) -> bool:
+        """
+        Build an architecture, tagging the records it logs with its name.
+
+        :param arch: name of the architecture, or None to leave records as is
+        """
+        token = _current_arch.set(arch)
+
+        try:
+            return self._make_arch(recipe, build_dir, packages)
+        finally:
+            _current_arch.reset(token)
+
     def _make_arch(
         self,
         recipe: Recipe,
@@ -219,30 +350,31 @@ or [k]eep it (not recommended)?",
     ) -> None:
         """Fetch and extract all source files required to build a recipe."""
         logger.info("Fetching source files")
+        checksums: Dict[Source, str] = {}
 
-        for source in recipe.sources:
-            filename = os.path.basename(source.url)
-            local_path = os.path.join(src_dir, filename)
+        with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+            # Start all network fetches concurrently, copy local files
+            # while they are running
+            downloads: Dict[Source, Future[str]] = {}
 
-            if self.URL_REGEX.match(source.url) is None:
-                # Get source file from the recipe’s directory
-                shutil.copy2(os.path.join(recipe.path, source.url), local_path)
-            else:
-                # Fetch source file from the network
-                req = requests.get(source.url, timeout=(3.05, 300))
-
-                if req.status_code != 200:
-                    raise BuildError(
-                        f"Unexpected status code while fetching \
-source file '{source.url}', got {req.status_code}"
+            for source in recipe.sources:
+                if not _is_url(source.url):
+                    checksums[source] = self._fetch_source(
+                        recipe, source, src_dir
+                    )
+                else:
+                    downloads[source] = executor.submit(
+                        self._fetch_source, recipe, source, src_dir
                     )
 
-                with open(local_path, "wb") as local:
-                    for chunk in req.iter_content(chunk_size=1024):
-                        local.write(chunk)
+            for source, download in downloads.items():
+                checksums[source] = download.result()
+
+        for source in recipe.sources:
+            local_path = os.path.join(src_dir, os.path.basename(source.url))
 
             # Verify checksum
-            file_sha = util.file_sha256(local_path)
+            file_sha = checksums[source]
             if source.checksum not in ("SKIP", file_sha):
                 raise BuildError(
                     f"Invalid checksum for source file {source.url}:\n"
@@ -258,6 +390,72 @@ source file '{source.url}', got {req.status_code}"
                         local_path,
                     )
 
+    def _fetch_source(
+        self,
+        recipe: Recipe,
+        source: Source,
+        src_dir: str,
+    ) -> str:
+        """
+        Fetch a single source file of a recipe.
+
+        :param recipe: recipe declaring the source file
+        :param source: source file to fetch
+        :param src_dir: directory in which to store the file
+        :returns: SHA-256 checksum of the fetched file
+        """
+        local_path = os.path.join(src_dir, os.path.basename(source.url))
+
+        # Hash the file contents while they are being written, instead of
+        # reading the whole file a second time afterwards
+        sha256 = hashlib.sha256()
+
+        if not _is_url(source.url):
+            # Get source file from the recipe’s directory
+            recipe_path = os.path.join(recipe.path, source.url)
+
+            with (
+                open(recipe_path, "rb") as recipe_file,
+                open(
+                    local_path, "wb", buffering=self.FETCH_CHUNK_SIZE
+                ) as local,
+            ):
+                while buffer := recipe_file.read(self.FETCH_CHUNK_SIZE):
+                    sha256.update(buffer)
+                    local.write(buffer)
+
+            shutil.copystat(recipe_path, local_path)
+        elif (
+            source.checksum != "SKIP"
+            and os.path.isfile(local_path)
+            and util.file_sha256(local_path) == source.checksum
+        ):
+            # Reuse the file fetched by a previous build in the same
+            # working directory
+            logger.debug("Using previously fetched %s", local_path)
+            return source.checksum
+        else:
+            # Fetch source file from the network
+            with self._http.get(
+                source.url, stream=True, timeout=(3.05, 300)
+            ) as req:
+                if req.status_code != 200:
+                    raise BuildError(
+                        f"Unexpected status code while fetching \
+source file '{source.url}', got {req.status_code}"
+                    )
+
+                with open(
+                    local_path, "wb", buffering=self.FETCH_CHUNK_SIZE
+                ) as local:
+                    for chunk in req.iter_content(
+                        chunk_size=self.FETCH_CHUNK_SIZE
+                    ):
+                        sha256.update(chunk)
+                        local.write(chunk)
+
+        return sha256.hexdigest()
+
     @staticmethod
     def _prepare(recipe: Recipe, src_dir: str) -> None:
         """Prepare source files before building."""
@@ -285,8 +483,7 @@ source file '{source.url}', got {req.status_code}"
         # Set fixed atime and mtime for all the source files
         epoch = int(recipe.timestamp.timestamp())
 
-        for filename in util.list_tree(src_dir):
-            os.utime(filename, (epoch, epoch))
+        util.set_tree_times(src_dir, epoch)
 
         mount_src = "/src"
         repo_src = "/repo"
@@ -405,12 +602,6 @@ source file '{source.url}', got {req.status_code}"
 
         # Convert install scripts to Debian format
         scripts = {}
-        script_header = textwrap.dedent(
-            """\
-            #!/usr/bin/env bash
-            set -euo pipefail
-            """
-        )
 
         for name, script, action in (
             ("preinstall", "preinst", "install"),
@@ -421,21 +612,10 @@ source file '{source.url}', got {req.status_code}"
             if function:
                 scripts[script] = "\n".join(
                     (
-                        script_header,
-                        textwrap.dedent(
-                            f"""\
-                            if [[ $1 = {action} ]]; then
-                                script() {{
-                            """
-                        ),
+                        _SCRIPT_HEADER,
+                        _SCRIPT_ACTION_OPEN.format(action=action),
                         function,
-                        textwrap.dedent(
-                            """\
-                                }
-                                script
-                            fi
-                            """
-                        ),
+                        _SCRIPT_ACTION_CLOSE,
                     )
                 )
 
@@ -443,32 +623,23 @@ source file '{source.url}', got {req.status_code}"
             if getattr(package, step + "upgrade") or getattr(
                 package, step + "remove"
             ):
-                script = script_header
+                parts = [_SCRIPT_HEADER]
 
                 for action in ("upgrade", "remove"):
                     function = getattr(package, step + action)
 
                     if function:
-                        script += "\n".join(
-                            (
-                                textwrap.dedent(
-                                    f"""\
-                                    if [[ $1 = {action} ]]; then
-                                        script() {{
-                                    """
-                                ),
-                                function,
-                                textwrap.dedent(
-                                    """\
-                                        }
-                                        script
-                                    fi
-                                    """
-                                ),
+                        parts.append(
+                            "\n".join(
+                                (
+                                    _SCRIPT_ACTION_OPEN.format(action=action),
+                                    function,
+                                    _SCRIPT_ACTION_CLOSE,
+                                )
                             )
                         )
 
-                scripts[step + "rm"] = script
+                scripts[step + "rm"] = "".join(parts)
 
         logger.debug("Install scripts:")
 
@@ -480,7 +651,12 @@ source file '{source.url}', got {req.status_code}"
 
         epoch = int(package.parent.timestamp.timestamp())
 
-        with open(ar_path, "wb") as file:
+        # Replace rather than overwrite any previous archive, which may be
+        # a hard link to a cached package
+        if os.path.lexists(ar_path):
+            os.unlink(ar_path)
+
+        with open(ar_path, "wb", buffering=1 << 20) as file:
             ipk.write(
                 file,
                 epoch=epoch,
@@ -5,24 +5,110 @@ After the artifacts are packaged, this hook will look for known install-lib
 methods and add them to scripts if found.
 """
 
+import functools
 import logging
+import re
 
-from typing import Set, Iterable
+from typing import Dict, FrozenSet, Pattern, Set, Tuple
 from toltec.builder import Builder
 from toltec.recipe import Package
 from toltec.util import listener
 
 logger = logging.getLogger(__name__)
 
-METHODS = {}
+METHODS: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
 
+# Bash definition of each method, ready to be spliced into scripts
+_DEFINITIONS: Dict[str, str] = {}
 
-def add_method(name: str, src: str, *depends: Iterable[str]) -> None:
+# Set of methods needed by each method (including itself), filled on first
+# use and reset whenever a method is added
+_CLOSURES: Dict[str, FrozenSet[str]] = {}
+
+
+def add_method(name: str, src: str, *depends: str) -> None:
     """Add a method to be automatically added to scripts that use it"""
     METHODS[name] = (
         src,
         depends,
     )
+    _DEFINITIONS[name] = f"\n{name}() {{\n    {src}\n}}\n"
+    _CLOSURES.clear()
+
+
+def _closure(name: str) -> FrozenSet[str]:
+    """
+    Get a method along with all the methods it transitively depends on.
+
+    :param name: name of the method
+    :returns: set of method names
+    """
+    closure = _CLOSURES.get(name)
+
+    if closure is None:
+        methods = {name}
+        pending = [name]
+
+        while pending:
+            _, depends = METHODS[pending.pop()]
+
+            for depend in depends:
+                if depend not in methods:
+                    methods.add(depend)
+                    pending.append(depend)
+
+        closure = _CLOSURES[name] = frozenset(methods)
+
+    return closure
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_methods(
+    names: Tuple[str, ...]
+) -> Tuple[Pattern[str], Dict[str, Set[str]]]:
+    """
+    Build a pattern that finds all occurrences of a set of method names in
+    a single pass over a script.
+
+    The pattern only reports the longest name starting at each position,
+    so the second returned value maps each name to the set of names that
+    it contains (including itself).
+
+    :param names: names of the methods to search for
+    :returns: compiled pattern and map of contained names
+    """
+    pattern = re.compile(
+        "(?=("
+        + "|".join(
+            re.escape(name) for name in sorted(names, key=len, reverse=True)
+        )
+        + "))"
+    )
+    contained = {
+        name: {other for other in names if other in name} for name in names
+    }
+    return pattern, contained
+
+
+def _find_methods(script: str) -> Set[str]:
+    """
+    Find the methods used by a script, along with all the methods they
+    depend on.
+
+    :param script: script to search
+    :returns: set of method names
+    """
+    if not METHODS:
+        return set()
+
+    pattern, contained = _compile_methods(tuple(METHODS))
+    methods: Set[str] = set()
+
+    for match in pattern.finditer(script):
+        for name in contained[match.group(1)]:
+            methods.update(_closure(name))
+
+    return methods
 
 
 def register(builder: Builder) -> None:
@@ -44,21 +130,14 @@ def register(builder: Builder) -> None:
             "preupgrade",
         ):
             function = getattr(package, name)
-            methods: Set[str] = set()
-            for method in METHODS:  # pylint: disable=consider-using-dict-items
-                if method in function:
-                    methods.add(method)
-                    src, depends = METHODS[method]
-                    methods.update(depends)  # type: ignore
-
-            for method in methods:
-                src, depends = METHODS[method]
-                function = f"""
-{method}() {{
-    {src}
-}}
-{function}
-"""
+            methods = sorted(_find_methods(function), reverse=True)
+
+            if methods:
+                function = (
+                    "".join(_DEFINITIONS[method] for method in methods)
+                    + function
+                    + "\n" * len(methods)
+                )
 
             setattr(package, name, function)
 
@@ -9,17 +9,103 @@ binaries. This behavior is only enabled if the recipe declares the
 'patch_rm2fb' flag.
 """
 
-import os
 import logging
-import shlex
-from elftools.elf.elffile import ELFFile
-from toltec.builder import Builder
+import mmap
+import tempfile
+import threading
+from io import BytesIO
+from weakref import WeakSet
+import docker
+from toltec.builder import Builder, BuildError
 from toltec.recipe import Recipe
 from toltec.util import listener
-from toltec.hooks.strip import walk_elfs, run_in_container, MOUNT_SRC
+from toltec.hooks.strip import (
+    scan_elfs,
+    refresh_elfs,
+    restore_mtimes,
+    run_in_container,
+    TOOLCHAIN,
+    write_file_list,
+)
 
 logger = logging.getLogger(__name__)
 
+# Local tag of the toolchain image extended with patchelf
+PATCHELF_IMAGE = TOOLCHAIN + "-patchelf"
+
+# Label of the patchelf image holding the ID of the toolchain image it was
+# built from
+PATCHELF_BASE_LABEL = "dev.toltec.base-image"
+
+# Maximum number of binaries passed to a single patchelf invocation
+PATCHELF_BATCH_SIZE = 1000
+
+# Builders for which the patchelf image is known to exist, and lock
+# preventing concurrent builds of the image from racing each other
+_patchelf_ready: "WeakSet[Builder]" = WeakSet()
+_patchelf_lock = threading.Lock()
+
+
+def _get_patchelf_image(builder: Builder) -> str:
+    """
+    Get the toolchain image extended with patchelf, building it the first
+    time it is needed.
+
+    The derived image is kept in the local Docker image store, so patchelf
+    is only installed once instead of on every build. It is labelled with
+    the ID of the toolchain image it was built from, and built again when
+    the toolchain image changes. The Docker daemon is only queried for it
+    once per builder.
+
+    :param builder: builder whose Docker client to use
+    :returns: tag of the image
+    :raises BuildError: if the image cannot be built
+    """
+    base_name = builder.IMAGE_PREFIX + TOOLCHAIN
+
+    with _patchelf_lock:
+        if builder in _patchelf_ready:
+            return PATCHELF_IMAGE
+
+        try:
+            try:
+                base = builder.docker.images.get(base_name)
+            except docker.errors.ImageNotFound:
+                base = builder.docker.images.pull(base_name)
+
+            try:
+                image = builder.docker.images.get(PATCHELF_IMAGE)
+                current = image.labels.get(PATCHELF_BASE_LABEL) == base.id
+            except docker.errors.ImageNotFound:
+                current = False
+
+            if not current:
+                logger.debug("Building the %s image", PATCHELF_IMAGE)
+                dockerfile = "\n".join(
+                    (
+                        f"FROM {base_name}",
+                        "RUN export DEBIAN_FRONTEND=noninteractive \\",
+                        "    && apt-get update -qq \\",
+                        "    && apt-get install -qq --no-install-recommends \\",
+                        "        patchelf \\",
+                        "    && rm -rf /var/lib/apt/lists/*",
+                    )
+                )
+                builder.docker.images.build(
+                    fileobj=BytesIO(dockerfile.encode()),
+                    tag=PATCHELF_IMAGE,
+                    labels={PATCHELF_BASE_LABEL: base.id},
+                    rm=True,
+                )
+        except (docker.errors.BuildError, docker.errors.APIError) as err:
+            raise BuildError(
+                f"Unable to build the {PATCHELF_IMAGE} image: {err}"
+            ) from err
+
+        _patchelf_ready.add(builder)
+
+    return PATCHELF_IMAGE
+
 
 def register(builder: Builder) -> None:
     """Register the hook"""
@@ -32,51 +118,58 @@ def register(builder: Builder) -> None:
             return
 
         logger.debug("Adding dependency to rm2fb ('patch_rm2fb' flag is set)")
-        # Search for binary objects that can be stripped
+        # Search for ARM binaries that access the framebuffer
         binaries = []
 
-        def filter_elfs(info: ELFFile, file_path: str) -> None:
-            symtab = info.get_section_by_name(".symtab")
-            if symtab is None or info.get_machine_arch() != "ARM":
-                return
-
-            dynamic = info.get_section_by_name(".dynamic")
-            rodata = info.get_section_by_name(".rodata")
-            if dynamic and rodata and rodata.data().find(b"/dev/fb0") != -1:
-                binaries.append(file_path)
-
-        walk_elfs(src_dir, filter_elfs)
-
-        if not binaries:
-            logger.debug("Skipping, no arm binaries found")
-            return
-
         # Save original mtimes to restore them afterwards
         # This will prevent any Makefile rules to be triggered again
         # in packaging scripts that use `make install`
         original_mtime = {}
 
-        script = [
-            "export DEBIAN_FRONTEND=noninteractive",
-            "apt-get update -qq",
-            "apt-get install -qq --no-install-recommends patchelf",
-        ]
+        for binary in scan_elfs(builder, src_dir):
+            if (
+                binary.arch != "ARM"
+                or not binary.symtab
+                or not binary.dynamic
+                or binary.rodata is None
+            ):
+                continue
+
+            # Search the section in place instead of copying it to memory
+            start, size = binary.rodata
+
+            with (
+                open(binary.path, "rb") as file,
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+            ):
+                if mapped.find(b"/dev/fb0", start, start + size) != -1:
+                    binaries.append(binary.path)
+                    original_mtime[binary.path] = binary.mtime
 
-        def docker_file_path(file_path: str) -> str:
-            return shlex.quote(
-                os.path.join(MOUNT_SRC, os.path.relpath(file_path, src_dir))
-            )
-
-        for file_path in binaries:
-            original_mtime[file_path] = os.stat(file_path).st_mtime_ns
-
-        script.append(
-            "patchelf --add-needed librm2fb_client.so.1 "
-            + " ".join(docker_file_path(file_path) for file_path in binaries)
-        )
+        if not binaries:
+            logger.debug("Skipping, no arm binaries found")
+            return
 
-        run_in_container(builder, src_dir, logger, script)
+        # Let xargs read the paths from a file, so that the script size does
+        # not depend on the number of binaries
+        with tempfile.TemporaryDirectory(
+            prefix=".toltec-lists-", dir=builder.work_dir
+        ) as lists_dir:
+            list_path = write_file_list(lists_dir, src_dir, binaries)
+            script = [
+                f"xargs -0 -r -a {list_path} -n {PATCHELF_BATCH_SIZE} "
+                "patchelf --add-needed librm2fb_client.so.1"
+            ]
+
+            run_in_container(
+                builder,
+                src_dir,
+                logger,
+                script,
+                _get_patchelf_image(builder),
+                lists_dir,
+            )
 
         # Restore original mtimes
-        for file_path, mtime in original_mtime.items():
-            os.utime(file_path, ns=(mtime, mtime))
+        restore_mtimes(original_mtime)
+        refresh_elfs(builder, src_dir, original_mtime)
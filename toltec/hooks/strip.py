@@ -9,51 +9,529 @@ behavior is disabled if the recipe declares the 'nostrip' flag.
 import os
 import logging
 import shlex
-from typing import Callable, List
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    IO,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from weakref import WeakKeyDictionary
 import docker
 from elftools.elf.elffile import ELFFile, ELFError
 from toltec import bash
 from toltec.builder import Builder
 from toltec.recipe import Recipe
-from toltec.util import listener
+from toltec.util import available_cpus, listener
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 MOUNT_SRC = "/src"
+
+# Mount point of the folder holding lists of files, in containers started
+# by run_in_container
+MOUNT_LISTS = "/lists"
+
 TOOLCHAIN = "toolchain:v1.3.1"
 
+# Identification bytes at the start of every ELF file
+ELF_MAGIC = b"\x7fELF"
+
+# Values of the e_machine ELF header field for supported architectures
+EM_386 = 0x03
+EM_ARM = 0x28
+EM_X86_64 = 0x3E
+
+# Architecture names for each supported e_machine value, as reported by
+# ELFFile.get_machine_arch()
+MACHINE_ARCHS = {EM_386: "x86", EM_ARM: "ARM", EM_X86_64: "x64"}
+
+# Struct formats of the ELF header (after e_ident) and of section headers,
+# indexed by the EI_CLASS identification byte (1 for 32-bit, 2 for 64-bit)
+_ELF_HEADER_FORMATS = {1: "HHIIIIIHHHHHH", 2: "HHIQQQIHHHHHH"}
+_SECTION_HEADER_FORMATS = {1: "IIIIIIIIII", 2: "IIQQQQIIQQ"}
+
+# Special section indices used when the actual value does not fit in the
+# ELF header and is stored in the first section header instead
+SHN_UNDEF = 0
+SHN_XINDEX = 0xFFFF
+
+# Extensions of common files that are never ELF binaries, which are
+# skipped without being opened when scanning build directories
+NON_ELF_EXTENSIONS = frozenset(
+    (
+        ".c",
+        ".cpp",
+        ".desktop",
+        ".h",
+        ".json",
+        ".md",
+        ".patch",
+        ".png",
+        ".py",
+        ".sh",
+        ".svg",
+        ".txt",
+        ".yaml",
+    )
+)
+
+# Number of files handed to each worker task when scanning a directory
+SCAN_BATCH_SIZE = 256
+
+# Maximum number of binaries passed to each parallel strip invocation
+STRIP_BATCH_SIZE = 64
+
+
+def _read_machine(file: IO[bytes]) -> Optional[int]:
+    """
+    Read the target machine of an ELF file from its header, without
+    parsing the rest of the file.
+
+    :param file: file opened in binary mode, positioned at its start
+    :returns: value of the e_machine field, or None if not an ELF file
+    """
+    # e_ident (16 bytes), e_type (2 bytes), e_machine (2 bytes)
+    header = file.read(20)
+
+    if len(header) < 20 or header[:4] != ELF_MAGIC:
+        return None
+
+    # EI_DATA is 1 for little-endian files and 2 for big-endian ones
+    return int.from_bytes(header[18:20], "big" if header[5] == 2 else "little")
+
+
+def _read_sections(  # pylint: disable=too-many-locals,too-many-return-statements
+    file: IO[bytes],
+) -> Optional[Tuple[int, Dict[str, Tuple[int, int]]]]:
+    """
+    Read the target machine and the sections of an ELF file directly from
+    its headers, which is much cheaper than a full parse with ELFFile.
+
+    :param file: file opened in binary mode
+    :returns: value of the e_machine field and map of each section name to
+        the file offset and size of that section, or None if the file is
+        not a valid ELF file
+    """
+    fd = file.fileno()
+    ident = os.pread(fd, 16, 0)
+
+    if (
+        len(ident) < 16
+        or ident[:4] != ELF_MAGIC
+        or ident[4] not in _ELF_HEADER_FORMATS
+    ):
+        return None
+
+    order = ">" if ident[5] == 2 else "<"
+    header = struct.Struct(order + _ELF_HEADER_FORMATS[ident[4]])
+    section = struct.Struct(order + _SECTION_HEADER_FORMATS[ident[4]])
+    file_size = os.fstat(fd).st_size
+
+    try:
+        fields = header.unpack(os.pread(fd, header.size, 16))
+        machine, shoff = fields[1], fields[5]
+        shentsize, shnum, shstrndx = fields[10:13]
+
+        if shoff == 0:
+            return machine, {}
+
+        if shentsize < section.size:
+            return None
+
+        # Section count and names index may overflow to the first header
+        first = section.unpack(os.pread(fd, section.size, shoff))
+
+        if shnum == 0:
+            shnum = first[5]
+
+        if shstrndx == SHN_XINDEX:
+            shstrndx = first[6]
+
+        if shoff + shnum * shentsize > file_size:
+            return None
+
+        table = os.pread(fd, shnum * shentsize, shoff)
+        headers = [
+            section.unpack_from(table, index * shentsize)
+            for index in range(shnum)
+        ]
+
+        if shstrndx == SHN_UNDEF:
+            return machine, {}
+
+        names_offset, names_size = headers[shstrndx][4:6]
+
+        if names_offset + names_size > file_size:
+            return None
+
+        names = os.pread(fd, names_size, names_offset)
+        sections: Dict[str, Tuple[int, int]] = {}
+
+        # Keep the first section with each name, like ELFFile does
+        for entry in headers:
+            end = names.find(b"\0", entry[0])
+            name = names[entry[0] : end if end >= 0 else None]
+            sections.setdefault(
+                name.decode("utf-8", errors="replace"), (entry[4], entry[5])
+            )
+
+        return machine, sections
+    except (struct.error, IndexError):
+        # Truncated or malformed headers
+        return None
+
+
+def _iter_files(root: str) -> Iterator[os.DirEntry]:
+    """
+    Recursively list the regular files in a directory that may be ELF
+    binaries.
+
+    Symbolic links are neither followed nor reported, and special files
+    such as sockets or FIFOs are skipped so that they never get opened.
+    Files with an extension from :data:`NON_ELF_EXTENSIONS` are skipped.
+
+    :param root: directory to walk through
+    :returns: iterator over the directory entries of the files
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+            elif (
+                entry.is_file(follow_symlinks=False)
+                and os.path.splitext(entry.name)[1] not in NON_ELF_EXTENSIONS
+            ):
+                yield entry
+
+
+def _map_files(src_dir: str, inspect: Callable[[os.DirEntry], T]) -> List[T]:
+    """
+    Run a method on all the files listed by :func:`_iter_files`, in parallel.
+
+    Files are dispatched to worker threads in batches to keep the
+    scheduling overhead low; since inspecting a file is mostly spent
+    waiting on I/O, more threads than CPUs are used.
+
+    :param src_dir: directory to walk through
+    :param inspect: method called with the directory entry of each file
+    :returns: results of the method, in traversal order
+    """
+    files = _iter_files(src_dir)
+    batches = iter(lambda: list(islice(files, SCAN_BATCH_SIZE)), [])
+    results: List[T] = []
+
+    with ThreadPoolExecutor(max_workers=2 * available_cpus()) as executor:
+        for batch in executor.map(
+            lambda batch: [inspect(entry) for entry in batch],
+            batches,
+        ):
+            results.extend(batch)
+
+    return results
+
+
+def walk_elfs(
+    src_dir: str,
+    for_each: Callable,
+    machines: Optional[Collection[int]] = None,
+) -> None:
+    """
+    Walk through all the ELF binaries in a directory and run a method for
+    each of them
+
+    Files are inspected in parallel, so :param:`for_each` may be called
+    concurrently from several threads and in no particular order.
+
+    :param src_dir: directory to walk through
+    :param for_each: method called with the parsed ELF file and its path
+    :param machines: if set, only run the method on ELF files whose
+        e_machine header field is part of this collection
+    """
+
+    def inspect(entry: os.DirEntry) -> None:
+        file_path = entry.path
+
+        try:
+            with open(file_path, "rb") as file:
+                # Cheaply skip non-ELF files and unwanted architectures
+                # before doing a full parse
+                machine = _read_machine(file)
+
+                if machine is None or (
+                    machines is not None and machine not in machines
+                ):
+                    return
+
+                file.seek(0)
+                for_each(ELFFile(file), file_path)
+        except ELFError:
+            # Ignore malformed ELF files
+            pass
+        except IsADirectoryError:
+            # Ignore directories
+            pass
+
+    _map_files(src_dir, inspect)
+
+
+class ElfInfo(NamedTuple):
+    """Properties of an ELF binary found in a build directory."""
+
+    # Path to the binary
+    path: str
+
+    # Target architecture, as reported by ELFFile.get_machine_arch()
+    arch: str
+
+    # True if the binary has a symbol table, i.e., if it is not stripped
+    symtab: bool
+
+    # True if the binary is dynamically linked
+    dynamic: bool
+
+    # File offset and size of the .rodata section, if there is one
+    rodata: Optional[Tuple[int, int]]
+
+    # Modification time of the binary when it was scanned, in nanoseconds
+    mtime: int
+
+
+# Results of scan_elfs() for each builder, indexed by build directory
+_scans: "WeakKeyDictionary[Builder, Dict[str, List[ElfInfo]]]" = (
+    WeakKeyDictionary()
+)
 
-def walk_elfs(src_dir: str, for_each: Callable) -> None:
-    """Walk through all the ELF binaries in a directory and run a method for each of them"""
-    for directory, _, files in os.walk(src_dir):
-        for file_name in files:
-            file_path = os.path.join(directory, file_name)
 
-            try:
-                with open(file_path, "rb") as file:
-                    for_each(ELFFile(file), file_path)
-            except ELFError:
-                # Ignore non-ELF files
-                pass
-            except IsADirectoryError:
-                # Ignore directories
-                pass
+def _inspect_elf(
+    file_path: str, get_stat: Callable[[], os.stat_result]
+) -> Optional[ElfInfo]:
+    """
+    Gather the properties of an ELF binary.
+
+    :param file_path: path to the file to inspect
+    :param get_stat: method returning the status of the file, only called
+        if the file is an ELF binary of a supported architecture
+    :returns: properties of the binary, or None if the file is not an ELF
+        binary of a supported architecture
+    """
+    with open(file_path, "rb") as file:
+        result = _read_sections(file)
+
+    if result is None or result[0] not in MACHINE_ARCHS:
+        return None
+
+    machine, sections = result
+    return ElfInfo(
+        path=file_path,
+        arch=MACHINE_ARCHS[machine],
+        symtab=".symtab" in sections,
+        dynamic=".dynamic" in sections,
+        rodata=sections.get(".rodata"),
+        mtime=get_stat().st_mtime_ns,
+    )
+
+
+def scan_elfs(builder: Builder, src_dir: str) -> List[ElfInfo]:
+    """
+    List the ELF binaries of all supported architectures in a build
+    directory.
+
+    The directory is only walked once per build, so that all the hooks
+    that need to inspect the built binaries can share the same results.
+    Hooks that modify binaries must call :func:`refresh_elfs` afterwards.
+
+    :param builder: builder building the recipe
+    :param src_dir: directory in which artifacts have been built
+    :returns: list of found binaries, in no particular order
+    """
+    scans = _scans.setdefault(builder, {})
+
+    if src_dir not in scans:
+        scans[src_dir] = [
+            binary
+            for binary in _map_files(
+                src_dir,
+                lambda entry: _inspect_elf(
+                    entry.path, lambda: entry.stat(follow_symlinks=False)
+                ),
+            )
+            if binary is not None
+        ]
+
+    return scans[src_dir]
+
+
+def refresh_elfs(
+    builder: Builder, src_dir: str, file_paths: Collection[str]
+) -> None:
+    """
+    Update the results of :func:`scan_elfs` after some binaries have been
+    modified, without walking the whole build directory again.
+
+    :param builder: builder building the recipe
+    :param src_dir: directory in which artifacts have been built
+    :param file_paths: paths to the modified binaries
+    """
+    scans = _scans.get(builder, {})
+
+    if src_dir not in scans:
+        return
+
+    changed = set(file_paths)
+    binaries = [
+        binary for binary in scans[src_dir] if binary.path not in changed
+    ]
+
+    for file_path in changed:
+        binary = _inspect_elf(file_path, partial(os.stat, file_path))
+
+        if binary is not None:
+            binaries.append(binary)
+
+    scans[src_dir] = binaries
+
+
+def restore_mtimes(original_mtime: Dict[str, int]) -> None:
+    """
+    Restore the modification times of a set of files.
+
+    Files are grouped by directory and each directory is opened once, so
+    that the kernel does not resolve the full path of every file.
+
+    :param original_mtime: modification time to set on each file, in
+        nanoseconds
+    """
+    by_directory: Dict[str, List[Tuple[str, int]]] = {}
+
+    for file_path, mtime in original_mtime.items():
+        directory, name = os.path.split(file_path)
+        by_directory.setdefault(directory or os.curdir, []).append(
+            (name, mtime)
+        )
+
+    def restore(item: Tuple[str, List[Tuple[str, int]]]) -> None:
+        directory, files = item
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+
+        try:
+            for name, mtime in files:
+                os.utime(name, ns=(mtime, mtime), dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        # Consume results to propagate errors
+        for _ in executor.map(restore, by_directory.items()):
+            pass
+
+
+def relative_path(src_dir: str, file_path: str) -> str:
+    """
+    Get the path of a file relative to the build directory containing it.
+
+    Paths found by scanning the directory start with the directory path
+    itself, so this avoids the cost of :func:`os.path.relpath` in the
+    common case.
+
+    :param src_dir: build directory
+    :param file_path: path to a file inside the build directory
+    :returns: relative path to the file
+    """
+    prefix = os.path.join(src_dir, "")
+
+    if file_path.startswith(prefix):
+        return file_path[len(prefix) :]
+
+    return os.path.relpath(file_path, src_dir)
+
+
+def write_file_list(lists_dir: str, src_dir: str, file_paths: List[str]) -> str:
+    """
+    Write a list of files of a build directory for use with `xargs -0 -a`
+    in containers started by :func:`run_in_container`.
+
+    Passing the list through a file instead of inlining it into the script
+    keeps the script size independent of the number of files, which would
+    otherwise be limited by the maximum size of a command line argument.
+    The list is written outside of the build directory, so that it is
+    never seen by the build or packaged, and removed along with the lists
+    folder.
+
+    :param lists_dir: folder in which to write the list, which has to be
+        passed to :func:`run_in_container`
+    :param src_dir: build directory
+    :param file_paths: paths to files inside the build directory
+    :returns: shell-quoted path to the list inside containers
+    """
+    fd, list_path = tempfile.mkstemp(suffix=".list", dir=lists_dir)
+
+    with os.fdopen(fd, "wb") as list_file:
+        list_file.write(
+            b"".join(
+                os.fsencode(
+                    os.path.join(MOUNT_SRC, relative_path(src_dir, file_path))
+                )
+                + b"\0"
+                for file_path in file_paths
+            )
+        )
+
+    return shlex.quote(f"{MOUNT_LISTS}/{os.path.basename(list_path)}")
 
 
 def run_in_container(
-    builder: Builder, src_dir: str, _logger: logging.Logger, script: List[str]
+    builder: Builder,
+    src_dir: str,
+    _logger: logging.Logger,
+    script: List[str],
+    image: Optional[str] = None,
+    lists_dir: Optional[str] = None,
 ) -> None:
-    """Run a script in a container and log output"""
-    logs = bash.run_script_in_container(
-        builder.docker,
-        image=builder.IMAGE_PREFIX + TOOLCHAIN,
-        mounts=[
+    """
+    Run a script in a container and log output
+
+    :param image: image to use for the container (default: the toolchain
+        image)
+    :param lists_dir: folder holding lists of files written by
+        :func:`write_file_list`, if any
+    """
+    mounts = [
+        docker.types.Mount(
+            type="bind",
+            source=os.path.abspath(src_dir),
+            target=MOUNT_SRC,
+        )
+    ]
+
+    if lists_dir is not None:
+        mounts.append(
             docker.types.Mount(
                 type="bind",
-                source=os.path.abspath(src_dir),
-                target=MOUNT_SRC,
+                source=os.path.abspath(lists_dir),
+                target=MOUNT_LISTS,
+                read_only=True,
             )
-        ],
+        )
+
+    logs = bash.run_script_in_container(
+        builder.docker,
+        image=image or builder.IMAGE_PREFIX + TOOLCHAIN,
+        mounts=mounts,
         variables={},
         script="\n".join(script),
     )
@@ -63,6 +541,15 @@ def run_in_container(
 def register(builder: Builder) -> None:
     """Register the hook"""
 
+    @listener(builder.post_prepare)
+    def post_prepare(
+        builder: Builder,
+        recipe: Recipe,  # pylint: disable=unused-argument
+        src_dir: str,
+    ) -> None:
+        # Binaries are about to be (re)built, forget any previous scan
+        _scans.get(builder, {}).pop(src_dir, None)
+
     @listener(builder.post_build)
     def post_build(  # pylint: disable=too-many-locals,too-many-branches
         builder: Builder, recipe: Recipe, src_dir: str
@@ -75,72 +562,71 @@ def register(builder: Builder) -> None:
         strip_arm: List[str] = []
         strip_x86: List[str] = []
 
-        def filter_elfs(info: ELFFile, file_path: str) -> None:
-            symtab = info.get_section_by_name(".symtab")
-            if not symtab:
-                return
-            if info.get_machine_arch() == "ARM":
-                strip_arm.append(file_path)
-            elif info.get_machine_arch() in ("x86", "x64"):
-                strip_x86.append(file_path)
-
-        walk_elfs(src_dir, filter_elfs)
-
-        if not strip_arm and not strip_x86:
-            logger.debug("Skipping, no binaries found")
-            return
-
         # Save original mtimes to restore them afterwards
         # This will prevent any Makefile rules to be triggered again
         # in packaging scripts that use `make install`
         original_mtime = {}
 
-        for file_path in strip_arm + strip_x86:
-            original_mtime[file_path] = os.stat(file_path).st_mtime_ns
+        for binary in scan_elfs(builder, src_dir):
+            if not binary.symtab:
+                continue
+            if binary.arch == "ARM":
+                strip_arm.append(binary.path)
+            elif binary.arch in ("x86", "x64"):
+                strip_x86.append(binary.path)
+            else:
+                continue
+            original_mtime[binary.path] = binary.mtime
+
+        if not strip_arm and not strip_x86:
+            logger.debug("Skipping, no binaries found")
+            return
 
         # Run strip on found binaries
         script = []
 
-        def docker_file_path(file_path: str) -> str:
-            return shlex.quote(
-                os.path.join(MOUNT_SRC, os.path.relpath(file_path, src_dir))
+        def strip_command(strip: str, list_path: str) -> str:
+            # Let xargs read the paths from a file and run strip on all cores
+            return (
+                f"xargs -0 -r -a {list_path} "
+                f'-P "$(nproc)" -n {STRIP_BATCH_SIZE} '
+                f"{strip} --strip-all --"
             )
 
-        # Strip debugging symbols and unneeded sections
-        if strip_x86:
-            script.append(
-                "strip --strip-all -- "
-                + " ".join(
-                    docker_file_path(file_path) for file_path in strip_x86
+        with tempfile.TemporaryDirectory(
+            prefix=".toltec-lists-", dir=builder.work_dir
+        ) as lists_dir:
+            # Strip debugging symbols and unneeded sections
+            if strip_x86:
+                script.append(
+                    strip_command(
+                        "strip",
+                        write_file_list(lists_dir, src_dir, strip_x86),
+                    )
                 )
-            )
 
-            logger.debug("x86 binaries to be stripped:")
+                logger.debug("x86 binaries to be stripped:")
 
-            for file_path in strip_x86:
-                logger.debug(
-                    " - %s",
-                    os.path.relpath(file_path, src_dir),
-                )
+                for file_path in strip_x86:
+                    logger.debug(" - %s", relative_path(src_dir, file_path))
 
-        if strip_arm:
-            script.append(
-                '"${CROSS_COMPILE}strip" --strip-all -- '
-                + " ".join(
-                    docker_file_path(file_path) for file_path in strip_arm
+            if strip_arm:
+                script.append(
+                    strip_command(
+                        '"${CROSS_COMPILE}strip"',
+                        write_file_list(lists_dir, src_dir, strip_arm),
+                    )
                 )
-            )
 
-            logger.debug("ARM binaries to be stripped:")
+                logger.debug("ARM binaries to be stripped:")
 
-            for file_path in strip_arm:
-                logger.debug(
-                    " - %s",
-                    os.path.relpath(file_path, src_dir),
-                )
+                for file_path in strip_arm:
+                    logger.debug(" - %s", relative_path(src_dir, file_path))
 
-        run_in_container(builder, src_dir, logger, script)
+            run_in_container(
+                builder, src_dir, logger, script, lists_dir=lists_dir
+            )
 
         # Restore original mtimes
-        for file_path, mtime in original_mtime.items():
-            os.utime(file_path, ns=(mtime, mtime))
+        restore_mtimes(original_mtime)
+        refresh_elfs(builder, src_dir, original_mtime)
@@ -3,20 +3,47 @@
 """Read and write ipk packages."""
 
 from gzip import GzipFile
-from typing import Dict, IO, Optional, Type, Union
+from typing import Dict, IO, Optional, Tuple, Type, Union
 from types import TracebackType
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 import tarfile
 import operator
 import os
+import stat
 
+# Size above which the data sub-archive of a package being written is
+# moved from memory to a temporary file
+SPOOL_MAX_SIZE = 16 << 20
 
-def _targz_open(fileobj: IO[bytes], epoch: int) -> tarfile.TarFile:
+# Default gzip compression level for package archives, which compresses
+# about as well as the maximum level in a fraction of the time
+COMPRESS_LEVEL = 6
+
+
+# Tar entry type for each supported file type, as given by stat.S_IFMT()
+_TAR_TYPES = {
+    stat.S_IFREG: tarfile.REGTYPE,
+    stat.S_IFDIR: tarfile.DIRTYPE,
+    stat.S_IFLNK: tarfile.SYMTYPE,
+    stat.S_IFIFO: tarfile.FIFOTYPE,
+    stat.S_IFCHR: tarfile.CHRTYPE,
+    stat.S_IFBLK: tarfile.BLKTYPE,
+}
+
+
+def _targz_open(
+    fileobj: IO[bytes], epoch: int, compresslevel: int = COMPRESS_LEVEL
+) -> tarfile.TarFile:
     """Open a gzip compressed tar archive for writing."""
     # HACK: Modified code from `tarfile.TarFile.gzopen` to support
     # setting the `mtime` attribute on `GzipFile`
     gzipobj = GzipFile(
-        filename="", mode="wb", compresslevel=9, fileobj=fileobj, mtime=epoch
+        filename="",
+        mode="wb",
+        compresslevel=compresslevel,
+        fileobj=fileobj,
+        mtime=epoch,
     )
 
     try:
@@ -80,8 +107,105 @@ def _add_file(
     archive.addfile(_clean_info(None, epoch, info), BytesIO(data))
 
 
+def _add_stream(
+    archive: tarfile.TarFile, name: str, mode: int, epoch: int, file: IO[bytes]
+) -> None:
+    """
+    Add a file from a stream into a tar archive.
+
+    :param archive: archive to append to
+    :param name: name of the file to add
+    :param mode: permissions of the file
+    :param epoch: fixed modification time to set
+    :param file: stream positioned at the end of the file contents, which
+        will be read back from its start
+    """
+    info = tarfile.TarInfo("./" + name)
+    info.size = file.tell()
+    info.mode = mode
+    file.seek(0)
+    archive.addfile(_clean_info(None, epoch, info), file)
+
+
+def _add_tree(  # pylint: disable=too-many-arguments
+    archive: tarfile.TarFile,
+    epoch: int,
+    path: str,
+    name: str,
+    stat_result: os.stat_result,
+    links: Dict[Tuple[int, int], str],
+) -> None:
+    """
+    Recursively add a file or directory tree into a tar archive.
+
+    This produces the same entries as :meth:`tarfile.TarFile.add`, but
+    reuses the file status gathered while listing each directory and skips
+    looking up user and group names, which are cleared anyway.
+
+    :param archive: archive to append to
+    :param epoch: fixed modification time to set
+    :param path: path to the file or directory to add
+    :param name: name of the entry in the archive
+    :param stat_result: status of the file, without following symlinks
+    :param links: name of the first entry added for each multiply-linked
+        inode, used to store further links to it as hard links
+    """
+    file_type = _TAR_TYPES.get(stat.S_IFMT(stat_result.st_mode))
+
+    if file_type is None:
+        # Ignore sockets and other unsupported file types
+        return
+
+    info = tarfile.TarInfo(name)
+    info.type = file_type
+    info.mode = stat.S_IMODE(stat_result.st_mode)
+
+    if file_type == tarfile.REGTYPE:
+        inode = (stat_result.st_ino, stat_result.st_dev)
+
+        if stat_result.st_nlink > 1 and inode in links:
+            info.type = tarfile.LNKTYPE
+            info.linkname = links[inode]
+        else:
+            info.size = stat_result.st_size
+
+            if stat_result.st_nlink > 1:
+                links[inode] = name
+    elif file_type == tarfile.SYMTYPE:
+        info.linkname = os.readlink(path)
+    elif file_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        info.devmajor = os.major(stat_result.st_rdev)
+        info.devminor = os.minor(stat_result.st_rdev)
+
+    _clean_info(None, epoch, info)
+
+    if info.type == tarfile.REGTYPE:
+        with open(path, "rb") as file:
+            archive.addfile(info, file)
+    else:
+        archive.addfile(info)
+
+    if file_type == tarfile.DIRTYPE:
+        with os.scandir(path) as entries:
+            children = sorted(entries, key=operator.attrgetter("name"))
+
+        for child in children:
+            _add_tree(
+                archive,
+                epoch,
+                child.path,
+                name + "/" + child.name,
+                child.stat(follow_symlinks=False),
+                links,
+            )
+
+
 def write_control(
-    file: IO[bytes], epoch: int, metadata: str, scripts: Dict[str, str]
+    file: IO[bytes],
+    epoch: int,
+    metadata: str,
+    scripts: Dict[str, str],
+    compresslevel: int = COMPRESS_LEVEL,
 ) -> None:
     """
     Create the control sub-archive of an ipk package.
@@ -93,8 +217,10 @@ def write_control(
     :param epoch: fixed modification time to set in the archive metadata
     :param metadata: package metadata (main control file)
     :param scripts: optional maintainer scripts
+    :param compresslevel: gzip compression level, from 1 (fastest) to 9
+        (smallest)
     """
-    with _targz_open(file, epoch) as archive:
+    with _targz_open(file, epoch, compresslevel) as archive:
         root_info = tarfile.TarInfo("./")
         root_info.type = tarfile.DIRTYPE
         root_info.mode = 0o755
@@ -110,6 +236,7 @@ def write_data(
     file: IO[bytes],
     epoch: int,
     pkg_dir: Optional[str] = None,
+    compresslevel: int = COMPRESS_LEVEL,
 ) -> None:
     """
     Create the data sub-archive of an ipk package.
@@ -118,20 +245,21 @@ def write_data(
     :param epoch: fixed modification time to set in the archive metadata
     :param pkg_dir: directory containing the package tree to include in the
         data sub-archive, leave empty to generate an empty data archive
+    :param compresslevel: gzip compression level, from 1 (fastest) to 9
+        (smallest)
     """
-    with _targz_open(file, epoch) as archive:
+    with _targz_open(file, epoch, compresslevel) as archive:
         if pkg_dir is not None:
-            archive.add(
-                pkg_dir, filter=lambda info: _clean_info(pkg_dir, epoch, info)
-            )
+            _add_tree(archive, epoch, pkg_dir, ".", os.lstat(pkg_dir), {})
 
 
-def write(
+def write(  # pylint: disable=too-many-arguments
     file: IO[bytes],
     epoch: int,
     metadata: str,
     scripts: Dict[str, str],
     pkg_dir: Optional[str] = None,
+    compresslevel: int = COMPRESS_LEVEL,
 ) -> None:
     """
     Create an ipk package.
@@ -142,26 +270,28 @@ def write(
     :param scripts: optional maintainer scripts
     :param pkg_dir: directory containing the package tree to include in the
         data sub-archive, leave empty to generate an empty data archive
+    :param compresslevel: gzip compression level, from 1 (fastest) to 9
+        (smallest)
     """
     with (
         BytesIO() as control,
-        BytesIO() as data,
-        _targz_open(file, epoch) as archive,
+        SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as data,
+        _targz_open(file, epoch, compresslevel) as archive,
     ):
         root_info = tarfile.TarInfo("./")
         root_info.type = tarfile.DIRTYPE
         archive.addfile(_clean_info(None, epoch, root_info))
 
-        write_control(control, epoch, metadata, scripts)
-        _add_file(archive, "control.tar.gz", 0o644, epoch, control.getvalue())
+        write_control(control, epoch, metadata, scripts, compresslevel)
+        _add_stream(archive, "control.tar.gz", 0o644, epoch, control)
 
-        write_data(data, epoch, pkg_dir)
-        _add_file(archive, "data.tar.gz", 0o644, epoch, data.getvalue())
+        write_data(data, epoch, pkg_dir, compresslevel)
+        _add_stream(archive, "data.tar.gz", 0o644, epoch, data)
 
         _add_file(archive, "debian-binary", 0o644, epoch, b"2.0\n")
 
 
-class Reader:
+class Reader:  # pylint: disable=too-many-instance-attributes
     """Read from ipk packages."""
 
     def __init__(self, file: Union[str, IO[bytes]]):
@@ -182,36 +312,60 @@ class Reader:
 
         self._root_archive: Optional[tarfile.TarFile] = None
         self._data_file: Optional[IO[bytes]] = None
+        self._data: Optional[tarfile.TarFile] = None
+        self._raw_scripts: Dict[str, bytes] = {}
+        self._scripts: Optional[Dict[str, str]] = None
 
-        self.data: Optional[tarfile.TarFile] = None
         self.metadata: Optional[str] = None
-        self.scripts: Dict[str, str] = {}
+
+    @property
+    def data(self) -> Optional[tarfile.TarFile]:
+        """
+        Data sub-archive of the package, opened on first access so that
+        reading only the package metadata does not decompress it.
+        """
+        if self._data is None and self._root_archive is not None:
+            data_file = self._root_archive.extractfile("./data.tar.gz")
+            assert data_file is not None
+            self._data_file = data_file
+            # pylint:disable-next=consider-using-with
+            self._data = tarfile.TarFile.open(fileobj=data_file, mode="r:gz")
+
+        return self._data
+
+    @property
+    def scripts(self) -> Dict[str, str]:
+        """Maintainer scripts of the package, decoded on first access."""
+        if self._scripts is None:
+            self._scripts = {
+                name: contents.decode("utf-8")
+                for name, contents in self._raw_scripts.items()
+            }
+
+        return self._scripts
 
     def __enter__(self) -> "Reader":
-        """Load package data to memory."""
+        """Load package metadata to memory."""
         root_archive = tarfile.TarFile.open(fileobj=self._file)
         control_file = root_archive.extractfile("./control.tar.gz")
         assert control_file is not None
 
         with control_file:
-            with tarfile.TarFile.open(fileobj=control_file) as control_archive:
+            with tarfile.TarFile.open(
+                fileobj=control_file, mode="r:gz"
+            ) as control_archive:
                 for member in control_archive.getmembers():
                     if member.isfile():
                         file = control_archive.extractfile(member)
                         assert file is not None
                         with file:
-                            contents = file.read().decode("utf-8")
+                            contents = file.read()
                             if member.name == "./control":
-                                self.metadata = contents
+                                self.metadata = contents.decode("utf-8")
                             else:
-                                self.scripts[member.name[2:]] = contents
+                                self._raw_scripts[member.name[2:]] = contents
 
-        data_file = root_archive.extractfile("./data.tar.gz")
-        assert data_file is not None
         self._root_archive = root_archive
-        self._data_file = data_file
-        self.data = tarfile.TarFile.open(fileobj=data_file)
-
         return self
 
     def __exit__(
@@ -221,9 +375,9 @@ class Reader:
         traceback: Optional[TracebackType],
     ) -> None:
         """Free resources containing package data."""
-        if self.data is not None:
-            self.data.close()
-            self.data = None
+        if self._data is not None:
+            self._data.close()
+            self._data = None
 
         if self._data_file is not None:
             self._data_file.close()
@@ -10,9 +10,8 @@ packages (in the latter case, it is called a split package).
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List, NamedTuple, Set
+from typing import Dict, FrozenSet, List, NamedTuple, Set
 import os
-import textwrap
 from .version import Version, Dependency
 
 
@@ -53,7 +52,7 @@ class Source(NamedTuple):
     noextract: bool
 
 
-@dataclass
+@dataclass(slots=True)
 class Recipe:  # pylint: disable=too-many-instance-attributes
     """Recipe declaring how a set of package can be built."""
 
@@ -67,7 +66,7 @@ class Recipe:  # pylint: disable=too-many-instance-attributes
     sources: Set[Source]
 
     # Set of packages that are needed to build this recipe
-    makedepends: Set[Dependency]
+    makedepends: FrozenSet[Dependency]
 
     # Full name and email address of this recipe’s maintainer
     maintainer: str
@@ -91,7 +90,7 @@ class Recipe:  # pylint: disable=too-many-instance-attributes
     packages: Dict[str, "Package"]
 
 
-@dataclass
+@dataclass(slots=True)
 class Package:  # pylint: disable=too-many-instance-attributes
     """Installable package containing build artifacts."""
 
@@ -117,22 +116,22 @@ class Package:  # pylint: disable=too-many-instance-attributes
     license: str
 
     # Set of packages that must be installed for this package to work
-    installdepends: Set[Dependency]
+    installdepends: FrozenSet[Dependency]
 
     # Set of packages that this package recommends installing
-    recommends: Set[Dependency]
+    recommends: FrozenSet[Dependency]
 
     # Set of packages that provide additional features for this package
-    optdepends: Set[Dependency]
+    optdepends: FrozenSet[Dependency]
 
     # Set of incompatible packages
-    conflicts: Set[Dependency]
+    conflicts: FrozenSet[Dependency]
 
     # Set of packages replaced by this package
-    replaces: Set[Dependency]
+    replaces: FrozenSet[Dependency]
 
     # Set of packages that this package provides
-    provides: Set[Dependency]
+    provides: FrozenSet[Dependency]
 
     # Bash script for packaging build artifacts
     package: str
@@ -167,18 +166,16 @@ class Package:  # pylint: disable=too-many-instance-attributes
 
     def control_fields(self) -> str:
         """Get the control fields for this package."""
-        control = textwrap.dedent(
-            f"""\
-            Package: {self.name}
-            Description: {self.desc}
-            Homepage: {self.url}
-            Version: {self.version}
-            Section: {self.section}
-            Maintainer: {self.parent.maintainer}
-            License: {self.license}
-            Architecture: {self.parent.arch}
-            """
-        )
+        fields = [
+            ("Package", self.name),
+            ("Description", self.desc),
+            ("Homepage", self.url),
+            ("Version", str(self.version)),
+            ("Section", self.section),
+            ("Maintainer", self.parent.maintainer),
+            ("License", self.license),
+            ("Architecture", self.parent.arch),
+        ]
 
         for debian_name, field in (
             ("Depends", self.installdepends),
@@ -189,11 +186,11 @@ class Package:  # pylint: disable=too-many-instance-attributes
             ("Provides", self.provides),
         ):
             if field:
-                control += (
-                    debian_name
-                    + ": "
-                    + ", ".join(sorted(dep.to_debian() for dep in field if dep))
-                    + "\n"
+                fields.append(
+                    (
+                        debian_name,
+                        ", ".join(sorted(dep.to_debian() for dep in field)),
+                    )
                 )
 
-        return control
+        return "".join(f"{name}: {value}\n" for name, value in fields)
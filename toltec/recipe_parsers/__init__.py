@@ -2,12 +2,32 @@
 # SPDX-License-Identifier: MIT
 """Recipe parsers."""
 
+import hashlib
+import os
+import pickle
+import pickletools
+import sys
+import warnings
+from typing import Iterable, Optional, Tuple
 from . import bash
+from .. import bash as script, recipe, util, version
 from ..recipe import RecipeBundle
 
 
 parsers = (bash,)
 
+# Pickle protocol used for caching parsed recipes
+CACHE_PICKLE_PROTOCOL = 5
+
+# Source files whose code determines the result of parsing a recipe,
+# cached recipes are discarded when any of them changes
+_PARSER_FILES = tuple(
+    module.__file__ or "" for module in (bash, script, recipe, version)
+) + (__file__,)
+
+# Length of the hexadecimal keys written at the start of cache entries
+_CACHE_KEY_LENGTH = 40
+
 
 def parse(path: str) -> RecipeBundle:
     """
@@ -19,13 +39,136 @@ def parse(path: str) -> RecipeBundle:
     :returns: loaded recipe
     """
     for parser in parsers:
-        try:
+        if parser.detect(path):
             # See <https://github.com/python/mypy/issues/9841>
             # and <https://github.com/python/mypy/issues/5018>
             return parser.parse(path)  # type: ignore
-        except FileNotFoundError:
-            pass
 
     raise FileNotFoundError(
         f"No recipe in a compatible format found in '{path}'"
     )
+
+
+def default_cache_dir() -> str:
+    """Get the directory in which parsed recipes are cached by default."""
+    return util.user_cache_dir("recipes")
+
+
+def _parser_files() -> Tuple[str, ...]:
+    """Get the files holding the code used for parsing recipes."""
+    # Modules of frozen applications are bundled inside the executable
+    # instead of being stored as separate source files
+    if getattr(sys, "frozen", False):
+        return (sys.executable,)
+
+    return _PARSER_FILES
+
+
+def _cache_key(path: str, exclude: Iterable[str] = ()) -> str:
+    """
+    Compute a key identifying the current state of a recipe.
+
+    All the files under the recipe directory are considered, since the
+    recipe may read any of them. Files are identified by their name,
+    modification time and size.
+
+    :param path: path to the directory containing the recipe definition
+    :param exclude: directories inside the recipe directory that do not
+        hold inputs of the recipe, such as the work and dist directories
+    :raises OSError: if the state of a file cannot be read
+    :returns: hexadecimal key
+    """
+    digest = hashlib.blake2b(digest_size=_CACHE_KEY_LENGTH // 2)
+    digest.update(os.path.abspath(path).encode())
+    digest.update(repr(sys.version_info[:2]).encode())
+
+    for parser_file in _parser_files():
+        stat = os.stat(parser_file)
+        digest.update(f"\0{stat.st_mtime_ns}:{stat.st_size}".encode())
+
+    util.update_tree_digest(
+        digest.update,
+        path,
+        exclude=(os.path.abspath(directory) for directory in exclude),
+    )
+    return digest.hexdigest()
+
+
+def parse_cached(
+    path: str,
+    cache_dir: Optional[str] = None,
+    exclude: Iterable[str] = (),
+) -> RecipeBundle:
+    """
+    Load a recipe, reusing the result of a previous parse if the recipe
+    has not changed since.
+
+    Recipes whose parsing emits warnings are not cached, so that the
+    warnings are shown on each run. Each recipe directory has a single
+    cache entry, which is replaced when the recipe changes.
+
+    :param path: path to the directory containing the recipe definition
+    :param cache_dir: directory in which parsed recipes are cached
+        (default: see :func:`default_cache_dir`)
+    :param exclude: directories inside the recipe directory whose contents
+        are not inputs of the recipe, such as the work and dist directories
+    :raises RecipeError: if there is an error in the recipe
+    :raises FileNotFoundError: if no recipe is found at the given path
+    :returns: loaded recipe
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    try:
+        key = _cache_key(path, exclude).encode()
+    except OSError:
+        return parse(path)
+
+    # Entries are named after the recipe directory and start with the key
+    # of the recipe state they were created from
+    name = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=20)
+    cache_path = os.path.join(cache_dir, name.hexdigest() + ".pickle")
+
+    try:
+        with open(cache_path, "rb") as cache_file:
+            if cache_file.read(_CACHE_KEY_LENGTH) == key:
+                return pickle.load(cache_file)
+    except Exception:  # pylint: disable=broad-exception-caught
+        # Missing, unreadable or outdated cache entry, replaced below.
+        # Unpickling a corrupted entry may raise about any exception
+        pass
+
+    with warnings.catch_warnings(record=True) as caught:
+        result = parse(path)
+
+    for warning in caught:
+        warnings.showwarning(
+            warning.message,
+            warning.category,
+            warning.filename,
+            warning.lineno,
+        )
+
+    if not caught:
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Optimizing drops unused memo entries, which makes the cached
+            # recipe faster to load on subsequent runs
+            with open(temp_path, "wb") as cache_file:
+                cache_file.write(key)
+                cache_file.write(
+                    pickletools.optimize(
+                        pickle.dumps(result, protocol=CACHE_PICKLE_PROTOCOL)
+                    )
+                )
+
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # The cache is only an optimization, failing to write it
+            # must not prevent the build
+            pass
+
+    return result
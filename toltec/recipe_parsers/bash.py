@@ -3,11 +3,21 @@
 """Parse recipes from Bash files."""
 
 import copy
+import re
 import warnings
+from datetime import datetime
+from functools import lru_cache
 from itertools import product
-from typing import Any, Dict, Generator, Iterable, Optional, Tuple
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 import os
-import dateutil.parser
 from ..version import (
     Version,
     InvalidVersionError,
@@ -26,6 +36,85 @@ from ..recipe import (
 )
 
 
+class _Field(NamedTuple):
+    """Declaration of a field read from a Bash variable."""
+
+    # Name of the Bash variable
+    name: str
+
+    # True if the variable is an indexed array, False if it is a string
+    indexed: bool = False
+
+    # Value used when the variable is not declared, None if it is required
+    default: Any = None
+
+    # Attribute to set to the raw value, if it can be used unconverted
+    attr: Optional[str] = None
+
+
+# Forms of ISO-8601 dates accepted in the timestamp field: an extended
+# calendar date, optionally followed by a time of day and a UTC offset.
+# datetime.fromisoformat also accepts other forms, such as week dates or
+# the basic format, which recipes are not expected to use
+_TIMESTAMP_FORMAT = re.compile(
+    r"\d{4}-\d{2}-\d{2}"
+    r"(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}(:?\d{2})?)?)?"
+)
+
+# Fields of recipes, in the order in which they are read
+_RECIPE_FIELDS = (
+    _Field("flags", indexed=True, default=()),
+    _Field("timestamp"),
+    _Field("source", indexed=True, default=()),
+    _Field("sha256sums", indexed=True, default=()),
+    _Field("noextract", indexed=True, default=()),
+    _Field("makedepends", indexed=True, default=()),
+    _Field("maintainer", attr="maintainer"),
+    _Field("image", default="", attr="image"),
+    _Field("arch", attr="arch"),
+)
+
+# Package fields containing sets of dependencies
+_PACKAGE_DEPENDENCY_FIELDS = (
+    "installdepends",
+    "recommends",
+    "optdepends",
+    "conflicts",
+    "replaces",
+    "provides",
+)
+
+# Fields of packages, in the order in which they are read
+_PACKAGE_FIELDS = (
+    _Field("pkgname", attr="name"),
+    _Field("pkgver"),
+    _Field("pkgdesc", attr="desc"),
+    _Field("url", attr="url"),
+    _Field("section", attr="section"),
+    _Field("license", attr="license"),
+) + tuple(
+    _Field(name, indexed=True, default=())
+    for name in _PACKAGE_DEPENDENCY_FIELDS
+)
+
+
+# Marker for variables that are not declared
+_MISSING: Any = object()
+
+# Maximum number of distinct source items shared between recipes
+_SOURCE_CACHE_SIZE = 4096
+
+
+def detect(path: str) -> bool:
+    """
+    Check whether a directory contains a recipe defined as a Bash file.
+
+    :param path: path to the directory to check
+    :returns: True if the directory contains a Bash recipe
+    """
+    return os.path.isfile(os.path.join(path, "package"))
+
+
 def parse(path: str) -> RecipeBundle:
     """
     Load a recipe defined as a Bash file.
@@ -62,33 +151,32 @@ def _instantiate_arch(
     archs = _pop_field_indexed(path, variables, "archs", ["rmall"])
     assert archs is not None
 
+    # Split variables suffixed with one of the architectures from
+    # normal variables, in a single pass
+    common_vars: bash.Variables = {}
+    arch_vars: Dict[Optional[str], bash.Variables] = {
+        arch: {} for arch in archs
+    }
+
+    for name, value in variables.items():
+        last_underscore = name.rfind("_")
+        name_arch = name[last_underscore + 1 :]
+
+        if last_underscore == -1 or name_arch not in arch_vars:
+            common_vars[name] = value
+        else:
+            arch_vars[name_arch][name[:last_underscore]] = value
+
     for arch in archs:
-        loc_vars: bash.Variables = copy.deepcopy(variables)
+        loc_vars: bash.Variables = copy.deepcopy(common_vars)
         loc_funcs: bash.Functions = copy.deepcopy(functions)
         loc_vars["arch"] = arch
 
         # Merge variables suffixed with the selected architecture
-        # into normal variables, drop other arch-specific declarations
-        for name, value in list(loc_vars.items()):
-            last_underscore = name.rfind("_")
-
-            if last_underscore == -1:
-                continue
-
-            name_arch = name[last_underscore + 1 :]
-
-            if name_arch not in archs:
-                continue
-
-            del loc_vars[name]
-
-            if name_arch != arch:
-                continue
-
-            name = name[:last_underscore]
-
+        # into normal variables, other arch-specific declarations are dropped
+        for name, value in arch_vars[arch].items():
             if name not in loc_vars:
-                loc_vars[name] = value
+                loc_vars[name] = copy.deepcopy(value)
                 continue
 
             normal_value = loc_vars[name]
@@ -133,28 +221,23 @@ def _parse_recipe(  # pylint: disable=too-many-locals, disable=too-many-statemen
     attrs: Dict[str, Any] = {}
     attrs["path"] = path
     raw_vars: bash.Variables = {}
+    fields = _pop_fields(path, variables, _RECIPE_FIELDS, attrs, raw_vars)
 
-    flags = raw_vars["flags"] = _pop_field_indexed(path, variables, "flags", [])
-    attrs["flags"] = [flag or "" for flag in flags]
-
-    timestamp_str = _pop_field_string(path, variables, "timestamp")
-    raw_vars["timestamp"] = timestamp_str
+    attrs["flags"] = [flag or "" for flag in fields["flags"]]
 
     try:
-        attrs["timestamp"] = dateutil.parser.isoparse(timestamp_str)
+        if not _TIMESTAMP_FORMAT.fullmatch(fields["timestamp"]):
+            raise ValueError(f"Unsupported date form: {fields['timestamp']}")
+
+        attrs["timestamp"] = datetime.fromisoformat(fields["timestamp"])
     except ValueError as err:
         raise RecipeError(
             path, "Field 'timestamp' does not contain a valid ISO-8601 date"
         ) from err
 
-    sources = _pop_field_indexed(path, variables, "source", [])
-    raw_vars["source"] = sources
-
-    sha256sums = _pop_field_indexed(path, variables, "sha256sums", [])
-    raw_vars["sha256sums"] = sha256sums
-
-    noextract = _pop_field_indexed(path, variables, "noextract", [])
-    raw_vars["noextract"] = noextract
+    sources = fields["source"]
+    sha256sums = fields["sha256sums"]
+    noextract = fields["noextract"]
 
     if len(sources) != len(sha256sums):
         raise RecipeError(
@@ -167,29 +250,15 @@ def _parse_recipe(  # pylint: disable=too-many-locals, disable=too-many-statemen
 
     for source, checksum in zip(sources, sha256sums):
         attrs["sources"].add(
-            Source(
+            _make_source(
                 url=source or "",
                 checksum=checksum or "SKIP",
                 noextract=os.path.basename(source or "") in noextract,
             )
         )
 
-    makedepends_raw = _pop_field_indexed(path, variables, "makedepends", [])
-    raw_vars["makedepends"] = makedepends_raw
-    attrs["makedepends"] = {
-        Dependency.parse(dep or "") for dep in makedepends_raw
-    }
-
-    attrs["maintainer"] = raw_vars["maintainer"] = _pop_field_string(
-        path, variables, "maintainer"
-    )
-
-    attrs["image"] = raw_vars["image"] = _pop_field_string(
-        path, variables, "image", ""
-    )
-
-    attrs["arch"] = raw_vars["arch"] = _pop_field_string(
-        path, variables, "arch"
+    attrs["makedepends"] = frozenset(
+        Dependency.parse(dep or "") for dep in fields["makedepends"]
     )
 
     if attrs["image"] and "build" not in functions:
@@ -225,9 +294,11 @@ build() step",
             copy.deepcopy(raw_vars),
             functions,
         )
+        context = None
     else:
         # Split-package recipe: load package-local declarations
         pkg_decls = {}
+        context = bash.put_variables({**raw_vars, **variables})
 
         for sub_pkg_name in pkgnames:
             assert sub_pkg_name is not None
@@ -240,14 +311,11 @@ corresponding package",
                 )
 
             pkg_def = functions.pop(sub_pkg_name)
-            context = bash.put_variables(
-                {
-                    **raw_vars,
-                    **variables,
-                    "pkgname": sub_pkg_name,
-                }
+            pkg_decls[sub_pkg_name] = bash.get_declarations(
+                context
+                + bash.put_variables({"pkgname": sub_pkg_name})
+                + pkg_def
             )
-            pkg_decls[sub_pkg_name] = bash.get_declarations(context + pkg_def)
 
             for var_name in raw_vars:
                 del pkg_decls[sub_pkg_name][0][var_name]
@@ -265,6 +333,7 @@ corresponding package",
         ("prepare", "build"),
         {**raw_vars, **variables},
         functions,
+        context,
     )
 
     return result
@@ -289,12 +358,10 @@ def _parse_package(  # pylint: disable=too-many-locals, disable=too-many-stateme
     attrs["parent"] = parent
 
     # Parse fields
-    attrs["name"] = raw_vars["pkgname"] = _pop_field_string(
-        parent.path, variables, "pkgname"
+    fields = _pop_fields(
+        parent.path, variables, _PACKAGE_FIELDS, attrs, raw_vars
     )
-
-    pkgver_str = _pop_field_string(parent.path, variables, "pkgver")
-    raw_vars["pkgver"] = pkgver_str
+    pkgver_str = fields["pkgver"]
 
     try:
         attrs["version"] = Version.parse(pkgver_str)
@@ -303,35 +370,10 @@ def _parse_package(  # pylint: disable=too-many-locals, disable=too-many-stateme
             parent.path, f"Failed to parse version number: '{pkgver_str}'"
         ) from err
 
-    attrs["desc"] = raw_vars["pkgdesc"] = _pop_field_string(
-        parent.path, variables, "pkgdesc"
-    )
-
-    attrs["url"] = raw_vars["url"] = _pop_field_string(
-        parent.path, variables, "url"
-    )
-
-    attrs["section"] = raw_vars["section"] = _pop_field_string(
-        parent.path, variables, "section"
-    )
-
-    attrs["license"] = raw_vars["license"] = _pop_field_string(
-        parent.path, variables, "license"
-    )
+    for field in _PACKAGE_DEPENDENCY_FIELDS:
+        deps = set()
 
-    for field in (
-        "installdepends",
-        "recommends",
-        "optdepends",
-        "conflicts",
-        "replaces",
-        "provides",
-    ):
-        field_raw = _pop_field_indexed(parent.path, variables, field, [])
-        raw_vars[field] = field_raw
-        attrs[field] = set()
-
-        for dep_raw in field_raw:
+        for dep_raw in fields[field]:
             assert dep_raw is not None
             try:
                 dep = Dependency.parse(dep_raw)
@@ -347,7 +389,9 @@ def _parse_package(  # pylint: disable=too-many-locals, disable=too-many-stateme
 '{field}' field, cannot add dependency '{dep}'",
                 )
 
-            attrs[field].add(dep)
+            deps.add(dep)
+
+        attrs[field] = frozenset(deps)
 
     # Parse functions
     attrs["package"] = functions.pop("package")
@@ -393,19 +437,77 @@ prefix the names of custom functions with '_'",
     return result
 
 
+@lru_cache(maxsize=_SOURCE_CACHE_SIZE)
+def _make_source(url: str, checksum: str, noextract: bool) -> Source:
+    """
+    Create a source item, sharing a single instance between all the
+    architectures and recipes that declare the same item.
+
+    :param url: URL or local relative path to the source item
+    :param checksum: SHA-256 checksum of the item
+    :param noextract: if true, the item is not extracted after downloading
+    :returns: source item
+    """
+    return Source(url=url, checksum=checksum, noextract=noextract)
+
+
+def _pop_fields(  # pylint: disable=too-many-arguments
+    path: str,
+    variables: bash.Variables,
+    fields: Iterable[_Field],
+    attrs: Dict[str, Any],
+    raw_vars: bash.Variables,
+) -> Dict[str, Any]:
+    """
+    Read a set of fields from Bash variables.
+
+    :param path: path to the recipe, for error reporting
+    :param variables: variables from which the fields are removed
+    :param fields: fields to read, in order
+    :param attrs: attributes to which fields that need no conversion are
+        directly assigned
+    :param raw_vars: raw values of fields, to which the read fields are
+        added
+    :raises RecipeError: if a required field is missing or if a field has
+        the wrong type
+    :returns: raw values of the read fields
+    """
+    values: Dict[str, Any] = {}
+
+    for field in fields:
+        if field.indexed:
+            value: Any = _pop_field_indexed(
+                path,
+                variables,
+                field.name,
+                None if field.default is None else list(field.default),
+            )
+        else:
+            value = _pop_field_string(
+                path, variables, field.name, field.default
+            )
+
+        values[field.name] = raw_vars[field.name] = value
+
+        if field.attr is not None:
+            attrs[field.attr] = value
+
+    return values
+
+
 def _pop_field_string(
     path: str,
     variables: bash.Variables,
     name: str,
     default: Optional[str] = None,
 ) -> str:
-    if name not in variables:
+    value = variables.pop(name, _MISSING)
+
+    if value is _MISSING:
         if default is None:
             raise RecipeError(path, f"Missing required field '{name}'")
         return default
 
-    value = variables.pop(name)
-
     if not isinstance(value, str):
         raise RecipeError(
             path,
@@ -421,13 +523,13 @@ def _pop_field_indexed(
     name: str,
     default: Optional[bash.IndexedArray] = None,
 ) -> bash.IndexedArray:
-    if name not in variables:
+    value = variables.pop(name, _MISSING)
+
+    if value is _MISSING:
         if default is None:
             raise RecipeError(path, f"Missing required field '{name}'")
         return default
 
-    value = variables.pop(name)
-
     if not isinstance(value, list):
         _name = type(value).__name__
         raise RecipeError(
@@ -443,14 +545,28 @@ def _add_script_header(
     keys: Iterable[str],
     variables: bash.Variables,
     functions: bash.Functions,
+    context: Optional[str] = None,
 ) -> None:
-    header = "\n".join(
-        (
-            bash.put_variables(variables),
-            bash.put_functions(functions),
-        )
-    )
+    """
+    Prefix scripts of a recipe or package with the declarations they use.
+
+    :param obj: recipe or package whose scripts are prefixed
+    :param keys: names of the script attributes to prefix
+    :param variables: variables available to the scripts
+    :param functions: functions available to the scripts
+    :param context: Bash fragment declaring the variables, if it was
+        already generated
+    """
+    scripts = [key for key in keys if getattr(obj, key)]
+
+    # Only generate the header if there is a script to prefix
+    if not scripts:
+        return
+
+    if context is None:
+        context = bash.put_variables(variables)
+
+    header = "\n".join((context, bash.put_functions(functions)))
 
-    for key in keys:
-        if getattr(obj, key):
-            setattr(obj, key, header + getattr(obj, key))
+    for key in scripts:
+        setattr(obj, key, header + getattr(obj, key))
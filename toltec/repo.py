@@ -5,17 +5,137 @@ Repository management.
 """
 
 import gzip
+import hashlib
+import json
 import locale
 import logging
+import operator
 import os
 import textwrap
-from .util import file_sha256
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from .util import available_cpus, stream_sha256, user_cache_dir
 from . import ipk
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of packages read at the same time when indexing
+INDEX_WORKERS = 32
 
-def make_index(base_dir: str, _start: bool = True) -> None:
+# Compression level of the gzipped index, favoring speed over size
+INDEX_COMPRESS_LEVEL = 1
+
+
+def _load_index_cache(cache_path: str) -> Dict[str, List[Any]]:
+    """
+    Load the index cache of a directory.
+
+    :param cache_path: path to the cache file
+    :returns: cached entries indexed by package file name, or an empty
+        dictionary if the cache is missing or unreadable
+    """
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+    return cache if isinstance(cache, dict) else {}
+
+
+def default_cache_dir() -> str:
+    """Get the directory in which package index entries are cached."""
+    return user_cache_dir("index")
+
+
+def _index_cache_path(cache_dir: str, base_dir: str) -> str:
+    """
+    Get the path to the index cache of a directory.
+
+    Caches are kept outside of the indexed directories, so that they are
+    not published along with the packages.
+
+    :param cache_dir: directory in which index caches are stored
+    :param base_dir: indexed directory
+    :returns: path to the cache file
+    """
+    key = hashlib.blake2b(
+        os.path.realpath(base_dir).encode(), digest_size=20
+    ).hexdigest()
+    return os.path.join(cache_dir, key + ".json")
+
+
+def _save_index_cache(cache_path: str, cache: Dict[str, List[Any]]) -> None:
+    """
+    Atomically replace the index cache of a directory.
+
+    :param cache_path: path to the cache file
+    :param cache: entries to store, indexed by package file name
+    """
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file)
+
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # The cache is only an optimization, failing to write it
+        # must not prevent indexing
+        pass
+
+
+def _index_entry(
+    entry: os.DirEntry,
+    cache: Dict[str, List[Any]],
+    new_cache: Dict[str, List[Any]],
+) -> str:
+    """
+    Generate the index entry of a package.
+
+    :param entry: directory entry of the package file
+    :param cache: entries cached from the last run, reused if the
+        package file has not changed since
+    :param new_cache: cache entries for the current run, to which the
+        entry for this package is added
+    :returns: index entry, consisting of the package metadata along with
+        the name, checksum and size of its file
+    """
+    # Packages are only read again if their file has changed since the
+    # last run. Built packages get a fixed modification time and recreated
+    # files may reuse the same inode, so the change time is also checked,
+    # which cannot be set by hand and changes whenever a file is written
+    stat = entry.stat()
+    key = [stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_ctime_ns]
+    cached = cache.get(entry.name)
+
+    if isinstance(cached, list) and cached[:4] == key:
+        metadata, checksum = cached[4:]
+    else:
+        # Open the file once for both hashing and reading the metadata,
+        # which is then read back from the page cache
+        with open(entry.path, "rb") as file:
+            checksum = stream_sha256(file)
+            file.seek(0)
+
+            with ipk.Reader(file) as package:
+                metadata = package.metadata
+                assert metadata is not None
+
+    new_cache[entry.name] = key + [metadata, checksum]
+    return metadata + textwrap.dedent(
+        f"""\
+        Filename: {entry.name}
+        SHA256sum: {checksum}
+        Size: {stat.st_size}
+
+        """
+    )
+
+
+def make_index(base_dir: str, cache_dir: Optional[str] = None) -> None:
     """
     Recursively generate index files for all the packages in folder.
 
@@ -24,35 +144,72 @@ def make_index(base_dir: str, _start: bool = True) -> None:
     contained directly in that folder.
 
     :param base_dir: directory to start the traversal from
+    :param cache_dir: directory in which the metadata and checksum of
+        packages are cached between calls (default: see
+        :func:`default_cache_dir`)
     """
-    if _start:
-        logger.info("Generating package index")
+    logger.info("Generating package index")
 
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    # All folders are indexed again so that removed packages are dropped
+    # from the index, unchanged packages being read from the cache
+    pending = [base_dir]
+
+    while pending:
+        pending.extend(_make_directory_index(pending.pop(), cache_dir))
+
+
+def _make_directory_index(base_dir: str, cache_dir: str) -> List[str]:
+    """
+    Generate the index files for the packages contained directly in a
+    folder.
+
+    :param base_dir: folder to index
+    :param cache_dir: directory in which index caches are stored
+    :returns: paths to the subfolders of the folder
+    """
     index_path = os.path.join(base_dir, "Packages")
     index_gzip_path = os.path.join(base_dir, "Packages.gz")
+    cache_path = _index_cache_path(cache_dir, base_dir)
+
+    cache = _load_index_cache(cache_path)
+    new_cache: Dict[str, List[Any]] = {}
+
+    packages: List[os.DirEntry] = []
+    subdirs: List[str] = []
 
-    with (
-        open(index_path, "w", encoding=locale.getencoding()) as index_file,
-        gzip.open(index_gzip_path, "wt") as index_gzip_file,
-    ):
-        for entry in os.scandir(base_dir):
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
             if entry.name in ("Packages", "Packages.gz"):
                 pass
             elif entry.is_dir():
-                make_index(entry.path, _start=False)
+                subdirs.append(entry.path)
             elif entry.is_file() and entry.name.endswith(".ipk"):
-                with ipk.Reader(entry.path) as package:
-                    metadata = package.metadata
-                    assert metadata is not None
+                packages.append(entry)
+
+    packages.sort(key=operator.attrgetter("name"))
+
+    # Reading and hashing packages is mostly I/O and hashlib work, both of
+    # which release the GIL, so packages are processed in parallel
+    with ThreadPoolExecutor(
+        max_workers=min(INDEX_WORKERS, 2 * available_cpus())
+    ) as executor:
+        index = "".join(
+            executor.map(
+                lambda entry: _index_entry(entry, cache, new_cache), packages
+            )
+        )
 
-                metadata += textwrap.dedent(
-                    f"""\
-                    Filename: {entry.name}
-                    SHA256sum: {file_sha256(entry.path)}
-                    Size: {os.path.getsize(entry.path)}
+    # Write the whole index at once so that it is compressed in one pass
+    with open(index_path, "w", encoding=locale.getencoding()) as index_file:
+        index_file.write(index)
 
-                    """
-                )
+    with gzip.open(
+        index_gzip_path, "wt", compresslevel=INDEX_COMPRESS_LEVEL
+    ) as index_gzip_file:
+        index_gzip_file.write(index)
 
-                index_file.write(metadata)
-                index_gzip_file.write(metadata)
+    _save_index_cache(cache_path, new_cache)
+    return subdirs
@@ -3,12 +3,15 @@
 """Collection of useful functions."""
 
 import argparse
+import atexit
 from collections.abc import Iterable
 import hashlib
 import logging
+import logging.handlers
 import itertools
 import functools
 import os
+import queue
 import shutil
 import sys
 from typing import (
@@ -26,6 +29,7 @@ from typing import (
 import warnings
 import zipfile
 import tarfile
+from types import TracebackType
 
 # Date format used in HTTP headers such as Last-Modified
 HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
@@ -33,6 +37,32 @@ HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
 # Logging format for build scripts
 LOGGING_FORMAT = "[%(levelname)8s] %(name)s: %(message)s"
 
+# Queue of log records written to stderr by a background thread, if
+# logging is set up that way (see setup_logging)
+_log_queue: Optional["queue.Queue[logging.LogRecord]"] = None
+
+
+class LogFormatter(logging.Formatter):
+    """
+    Log formatter that prefixes the message of records with the
+    architecture whose build emitted them, if any.
+
+    Records are tagged with their architecture by the builder, in their
+    ``arch`` attribute, when several architectures are built at once.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        arch = getattr(record, "arch", None)
+
+        if arch is None:
+            return super().format(record)
+
+        # Format a copy so that the record is left as is for other handlers
+        tagged = logging.makeLogRecord(record.__dict__)
+        tagged.msg = f"[{arch}] {record.getMessage()}"
+        tagged.args = None
+        return super().format(tagged)
+
 
 def argparse_add_verbose(parser: argparse.ArgumentParser) -> None:
     """Add a CLI option for setting the verbosity level."""
@@ -59,10 +89,57 @@ warnings into exceptions""",
     )
 
 
+def flush_logging() -> None:
+    """Wait until all queued log records have been written to stderr."""
+    # The listener marks each record as done once it has been handled
+    if _log_queue is not None:
+        _log_queue.join()
+
+
+@functools.cache
+def _install_log_flush() -> None:
+    """
+    Flush queued log records before exiting or printing a traceback.
+
+    The hooks are only installed on the first call.
+    """
+    atexit.register(flush_logging)
+    previous_excepthook = sys.excepthook
+
+    def excepthook(
+        exc_type: Type[BaseException],
+        exc_value: BaseException,
+        exc_traceback: Optional[TracebackType],
+    ) -> None:
+        flush_logging()
+        previous_excepthook(exc_type, exc_value, exc_traceback)
+
+    sys.excepthook = excepthook
+
+
 def setup_logging(args: argparse.Namespace) -> None:
     """Configure logging and warning control based on passed CLI flags."""
-    if hasattr(args, "verbose"):
-        logging.basicConfig(format=LOGGING_FORMAT, level=args.verbose)
+    global _log_queue  # pylint: disable=global-statement
+    root = logging.getLogger()
+
+    # Like logging.basicConfig, leave an already configured root logger
+    # alone. Interactive sessions write records to stderr directly, so
+    # that they stay in order with prompts and tracebacks
+    if hasattr(args, "verbose") and not root.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(LogFormatter(LOGGING_FORMAT))
+        root.setLevel(args.verbose)
+
+        if sys.stderr.isatty():
+            root.addHandler(stream_handler)
+        else:
+            # Otherwise, records are queued and written to stderr by a
+            # background thread, so that parallel builds do not contend
+            # for the stream lock
+            _log_queue = queue.Queue()
+            logging.handlers.QueueListener(_log_queue, stream_handler).start()
+            root.addHandler(logging.handlers.QueueHandler(_log_queue))
+            _install_log_flush()
 
     def formatwarning(
         message: Union[str, Warning],
@@ -81,19 +158,50 @@ def setup_logging(args: argparse.Namespace) -> None:
         warnings.simplefilter(args.warnings)
 
 
-def file_sha256(path: str) -> str:
-    """Compute the SHA-256 checksum of a file."""
+def available_cpus() -> int:
+    """
+    Get the number of CPUs the current process is allowed to run on.
+
+    This can be lower than the number of CPUs of the machine, for example
+    in containers or on CI runners restricted to a subset of them.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def stream_sha256(file: IO[bytes]) -> str:
+    """Compute the SHA-256 checksum of a binary stream, up to its end."""
     sha256 = hashlib.sha256()
     buffer = bytearray(128 * 1024)
     view = memoryview(buffer)
 
-    with open(path, "rb", buffering=0) as file:
-        for length in iter(lambda: file.readinto(view), 0):  # type:ignore
-            sha256.update(view[:length])
+    for length in iter(lambda: file.readinto(view), 0):  # type:ignore
+        sha256.update(view[:length])
 
     return sha256.hexdigest()
 
 
+def file_sha256(path: str) -> str:
+    """Compute the SHA-256 checksum of a file."""
+    with open(path, "rb", buffering=0) as file:
+        return stream_sha256(file)
+
+
+def user_cache_dir(name: str) -> str:
+    """
+    Get the path to a directory in which data can be cached between runs.
+
+    :param name: name of the cached data
+    :returns: path to the directory, which may not exist yet
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "toltec", name)
+
+
 def split_all_parts(path: str) -> List[str]:
     """Split a file path into all its directory components."""
     parts = []
@@ -275,6 +383,9 @@ def query_user(
         option if option != default else option.upper() for option in options
     )
 
+    # Show pending log records before the question
+    flush_logging()
+
     while True:
         sys.stdout.write(f"{question} [{prompt}] ")
         choice = input().lower()
@@ -340,6 +451,63 @@ def list_tree(root: str) -> List[str]:
     return sorted(result)
 
 
+def update_tree_digest(
+    update: Callable[[bytes], None],
+    root: str,
+    exclude: Iterable[str] = (),
+    suffix: str = "",
+) -> None:
+    """
+    Add the name, modification time and size of every file in a tree to a
+    digest, in a stable order.
+
+    :param update: function updating the digest
+    :param root: root of the tree
+    :param exclude: absolute paths of directories to skip
+    :param suffix: only consider files whose name ends with this suffix
+    """
+    excluded = set(exclude)
+    pending = [root]
+
+    while pending:
+        path = pending.pop()
+
+        with os.scandir(path) as entries:
+            entries_list = sorted(entries, key=lambda entry: entry.name)
+
+        for entry in entries_list:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.abspath(entry.path) not in excluded:
+                    pending.append(entry.path)
+            elif entry.is_file() and entry.name.endswith(suffix):
+                stat = entry.stat()
+                name = os.path.relpath(entry.path, root)
+                item = f"\0{name}\0{stat.st_mtime_ns}:{stat.st_size}"
+                update(item.encode())
+
+
+def set_tree_times(root: str, timestamp: int) -> None:
+    """
+    Set the access and modification times of a folder and of all the files
+    and folders under it.
+
+    Dangling symbolic links are skipped.
+
+    :param root: root folder to start from
+    :param timestamp: time to set, in seconds since the epoch
+    """
+    # Walk bottom-up so that each folder is stamped after its contents
+    # have been listed, with a single listing of each folder
+    for directory, dirnames, filenames in os.walk(root, topdown=False):
+        for name in dirnames + filenames:
+            try:
+                os.utime(os.path.join(directory, name), (timestamp, timestamp))
+            except FileNotFoundError:
+                pass
+
+    os.utime(root, (timestamp, timestamp))
+
+
 HookTrigger = Callable[..., None]
 HookListener = Callable[..., None]
 
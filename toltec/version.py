@@ -11,24 +11,35 @@ taken from Debian’s. See:
 """
 
 import re
-from functools import total_ordering
+import string
+from dataclasses import dataclass, field
+from functools import lru_cache, total_ordering
 from enum import Enum
-from typing import Optional, Callable
+from typing import Optional
 
 # Characters permitted in the upstream part of a version number
 _UPSTREAM_CHARS = "A-Za-z0-9.+~-"
-_UPSTREAM_REGEX = re.compile(f"^[{_UPSTREAM_CHARS}]*$")
+_UPSTREAM_DELETE = str.maketrans(
+    "", "", string.ascii_letters + string.digits + ".+~-"
+)
 
 # Characters permitted in the revision part of a version number
 _REVISION_CHARS = "A-Za-z0-9.+~"
-_REVISION_REGEX = re.compile(f"^[{_REVISION_CHARS}]*$")
+_REVISION_DELETE = str.maketrans(
+    "", "", string.ascii_letters + string.digits + ".+~"
+)
+
+# Maximum number of parsed versions and dependencies kept in memory
+_PARSE_CACHE_SIZE = 4096
 
-# Characters making up a version comparator
-_COMPARATOR_CHARS = re.compile("[<>=]+")
+# Regex splitting a dependency specification into its kind, package name,
+# version comparator and version number
+_DEPENDENCY_REGEX = re.compile(
+    "(?:([^:<>=]*):)?([^<>=]*)(?:([<>=]+)(.*))?", re.DOTALL
+)
 
-# Regex used to find digit and non-digit chars
-_DIGIT_REGEX = re.compile("[0-9]")
-_NON_DIGIT_REGEX = re.compile("[^0-9]")
+# Regex used to split a version part into non-digit and digit runs
+_VERSION_PARTS_REGEX = re.compile("([^0-9]*)([0-9]*)")
 
 # Sorting key used for non-digit version parts
 _ALPHA_SORT_KEY = (
@@ -45,72 +56,35 @@ _ALPHA_SORT_KEY = (
     )
 )
 
+# Translation table mapping each non-digit char to its rank in _ALPHA_SORT_KEY
+_ALPHA_SORT_TABLE = bytes.maketrans(
+    "".join(char for char in _ALPHA_SORT_KEY if char is not None).encode(),
+    bytes(
+        index for index, char in enumerate(_ALPHA_SORT_KEY) if char is not None
+    ),
+)
 
-def _find_digit(string: str) -> int:
-    """
-    Find the index of the first digit char in a string, or return the
-    length of the string if there is none.
-    """
-    matches = _DIGIT_REGEX.search(string)
-    return len(string) if not matches else matches.start()
+# Rank appended to each non-digit run, standing for the end of the run
+_ALPHA_SORT_END = bytes((_ALPHA_SORT_KEY.index(None),))
 
 
-def _find_non_digit(string: str) -> int:
-    """
-    Find the index of the first non-digit char in a string, or return the
-    length of the string if there is none.
+def _version_part_key(part: str) -> tuple[tuple[bytes, int], ...]:
     """
-    matches = _NON_DIGIT_REGEX.search(string)
-    return len(string) if not matches else matches.start()
-
+    Compute a key ordering parts of a version string according to Debian
+    version sorting rules.
 
-def _compare_version_parts(left: str, right: str) -> bool:
+    The part is split into alternating non-digit and numeric runs. Non-digit
+    runs are ranked char by char using _ALPHA_SORT_KEY and numeric runs are
+    compared as integers, so that comparing two keys is equivalent to
+    comparing the parts they were computed from.
     """
-    Compare two parts of a version string according to Debian version
-    sorting rules.
-    :returns: true if and only if `left` is strictly lower than `right`
-    """
-
-    def split(
-        string: str, index_finder: Callable[[str], int]
-    ) -> tuple[str, str]:
-        index = index_finder(string)
-        return string[:index], string[index:]
-
-    def map_alpha(string: str, length: int) -> tuple[int, ...]:
-        return tuple(
-            (
-                _ALPHA_SORT_KEY.index(string[i])
-                if i in range(len(string))
-                else _ALPHA_SORT_KEY.index(None)
-            )
-            for i in range(length)
+    return tuple(
+        (
+            alpha.encode().translate(_ALPHA_SORT_TABLE) + _ALPHA_SORT_END,
+            int(digits) if digits else 0,
         )
-
-    # Split the strings into alternating non-digit parts and numeric parts,
-    # compare non-digit parts using _ALPHA_SORT_KEY and numeric parts as
-    # integers, stop at the first non-equal part
-    while left or right:
-        left_alpha, left = split(left, _find_digit)
-        right_alpha, right = split(right, _find_digit)
-
-        max_len = max(len(left_alpha), len(right_alpha))
-        left_map = map_alpha(left_alpha, max_len)
-        right_map = map_alpha(right_alpha, max_len)
-
-        if left_map != right_map:
-            return left_map < right_map
-
-        left_digit, left = split(left, _find_non_digit)
-        right_digit, right = split(right, _find_non_digit)
-
-        left_numeric = int(left_digit)
-        right_numeric = int(right_digit)
-
-        if left_numeric != right_numeric:
-            return left_numeric < right_numeric
-
-    return False
+        for alpha, digits in _VERSION_PARTS_REGEX.findall(part)
+    )
 
 
 class VersionComparator(Enum):
@@ -128,6 +102,7 @@ class InvalidVersionError(Exception):
 
 
 @total_ordering
+@dataclass(frozen=True, slots=True)
 class Version:
     """
     Parse package versions.
@@ -135,10 +110,24 @@ class Version:
     for details about the format and the comparison rules.
     """
 
-    def __init__(self, epoch: int, upstream: str, revision: str):
-        self.upstream = upstream
-        self.revision = revision
-        self.epoch = epoch
+    epoch: int
+    upstream: str
+    revision: str
+
+    # Original version string, if this version was parsed from one
+    _original: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    # Sorting key, computed on the first comparison
+    _sort_key: Optional[tuple] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        epoch = self.epoch
+        upstream = self.upstream
+        revision = self.revision
 
         if epoch < 0:
             raise InvalidVersionError(
@@ -149,7 +138,7 @@ class Version:
         if not upstream:
             raise InvalidVersionError("Upstream version cannot be empty")
 
-        if _UPSTREAM_REGEX.fullmatch(upstream) is None:
+        if upstream.translate(_UPSTREAM_DELETE):
             raise InvalidVersionError(
                 f"Invalid chars in upstream version '{upstream}', allowed "
                 f"chars are {_UPSTREAM_CHARS}"
@@ -158,15 +147,14 @@ class Version:
         if not revision:
             raise InvalidVersionError("Revision cannot be empty")
 
-        if _REVISION_REGEX.fullmatch(revision) is None:
+        if revision.translate(_REVISION_DELETE):
             raise InvalidVersionError(
                 f"Invalid chars in revision '{revision}' allowed chars "
                 f"are {_REVISION_CHARS}"
             )
 
-        self._original: Optional[str] = None
-
     @staticmethod
+    @lru_cache(maxsize=_PARSE_CACHE_SIZE)
     def parse(version: str) -> "Version":
         """Parse a version number."""
         original = version
@@ -196,7 +184,7 @@ class Version:
         upstream = version
 
         result = Version(epoch, upstream, revision)
-        result._original = original  # pylint:disable=protected-access
+        object.__setattr__(result, "_original", original)
         return result
 
     def __str__(self) -> str:
@@ -231,13 +219,21 @@ revision={repr(self.revision)}, epoch={repr(self.epoch)})"
         if not isinstance(other, Version):
             return NotImplemented
 
-        if self.epoch != other.epoch:
-            return self.epoch < other.epoch
+        return self.sort_key() < other.sort_key()
 
-        if self.upstream != other.upstream:
-            return _compare_version_parts(self.upstream, other.upstream)
+    def sort_key(self) -> tuple:
+        """Get a key ordering versions according to Debian rules."""
+        key = self._sort_key
 
-        return _compare_version_parts(self.revision, other.revision)
+        if key is None:
+            key = (
+                self.epoch,
+                _version_part_key(self.upstream),
+                _version_part_key(self.revision),
+            )
+            object.__setattr__(self, "_sort_key", key)
+
+        return key
 
     def __hash__(self) -> int:
         return hash((self.epoch, self.upstream, self.revision))
@@ -258,6 +254,7 @@ class InvalidDependencyError(Exception):
     """Raised when parsing an invalid dependency specification."""
 
 
+@dataclass(frozen=True, slots=True)
 class Dependency:
     """
     Parse version-constrained dependencies.
@@ -273,73 +270,70 @@ class Dependency:
     building the package, or in the target device when using it.
     """
 
-    def __init__(
-        self,
-        kind: DependencyKind,
-        package: str,
-        version_comparator: VersionComparator = VersionComparator.EQUAL,
-        version: Optional[Version] = None,
-    ):
-        self.kind = kind
-        self.package = package
-        self.version_comparator = version_comparator
-        self.version = version
+    kind: DependencyKind
+    package: str
+    version_comparator: VersionComparator = VersionComparator.EQUAL
+    version: Optional[Version] = None
+
+    # Original dependency specification, if this dependency was parsed
+    _original: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    # Specification in the Debian format, computed once on creation
+    _debian: str = field(default="", init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        if self.version is None:
+            debian = self.package
+        else:
+            debian = f"{self.package} ({self.version_comparator.value} \
+{self.version})"
 
-        self._original: Optional[str] = None
+        object.__setattr__(self, "_debian", debian)
 
     @staticmethod
+    @lru_cache(maxsize=_PARSE_CACHE_SIZE)
     def parse(dependency: str) -> "Dependency":
         """Parse a dependency specification."""
-        original = dependency
-        comp_match = _COMPARATOR_CHARS.search(dependency)
+        match = _DEPENDENCY_REGEX.fullmatch(dependency)
+        assert match is not None
+        kind_str, package, comparator_str, version_str = match.groups()
 
-        if comp_match is None:
+        if comparator_str is None:
             version_comparator = VersionComparator.EQUAL
             version = None
         else:
-            comparator_str = comp_match.group(0)
-            comp_char = comp_match.start()
-
-            for enum_comparator in VersionComparator:
-                if enum_comparator.value == comparator_str:
-                    version_comparator = enum_comparator
-                    version = Version.parse(dependency[comp_match.end() :])
-                    dependency = dependency[: comp_match.start()]
-                    break
-            else:
+            try:
+                version_comparator = VersionComparator(comparator_str)
+            except ValueError as err:
                 raise InvalidDependencyError(
-                    f"Invalid version comparator '{comp_char}', valid types "
-                    "are "
+                    f"Invalid version comparator '{comparator_str}', valid \
+types are "
                     + ",".join(
                         f"'{enum_comparator.value}'"
                         for enum_comparator in VersionComparator
                     )
-                )
+                ) from err
 
-        colon = dependency.find(":")
+            version = Version.parse(version_str)
 
-        if colon == -1:
+        if kind_str is None:
             kind = DependencyKind.HOST
-            package = dependency
         else:
-            dep_kind_str = dependency[:colon]
-
-            for enum_kind in DependencyKind:
-                if enum_kind.value == dep_kind_str:
-                    kind = enum_kind
-                    package = dependency[colon + 1 :]
-                    break
-            else:
+            try:
+                kind = DependencyKind(kind_str)
+            except ValueError as err:
                 raise InvalidDependencyError(
-                    f"Unknown dependency type '{dep_kind_str}', valid types "
+                    f"Unknown dependency type '{kind_str}', valid types "
                     "are "
                     + ",".join(
                         f"'{enum_kind.value}'" for enum_kind in DependencyKind
                     )
-                )
+                ) from err
 
         result = Dependency(kind, package, version_comparator, version)
-        result._original = original  # pylint:disable=protected-access
+        object.__setattr__(result, "_original", dependency)
         return result
 
     def match(self, version: Version) -> bool:
@@ -364,11 +358,7 @@ class Dependency:
 
     def to_debian(self) -> str:
         """Convert a dependency specification to the Debian format."""
-        if self.version is None:
-            return self.package
-
-        return f"{self.package} ({self.version_comparator.value} \
-{self.version})"
+        return self._debian
 
     def __str__(self) -> str:
         if self._original is not None: